@@ -0,0 +1,469 @@
+#!/usr/bin/env python
+
+'''
+benchmark.py
+============
+Benchmarks for the moving parts of danbooru.py, and for whole runs against
+a local stand-in for danbooru (a MockServer with configurable latency,
+bandwidth and error rate).
+
+usage examples
+==============
+ * benchmark.py
+   Run every benchmark
+ * benchmark.py parse files
+   Run only the named benchmarks
+ * benchmark.py mock
+   Download, catalogue and rename files served by a MockServer
+'''
+
+import os
+import sys
+import shutil
+import sqlite3
+import pickle
+import random
+import threading
+import BaseHTTPServer
+import SocketServer
+
+from cStringIO import StringIO
+from hashlib import md5
+from tempfile import mkdtemp
+from time import time, sleep
+from urlparse import urlsplit, parse_qsl
+from xml.dom import minidom
+from xml.sax.saxutils import quoteattr
+
+import danbooru
+
+# Attributes of a post as returned by post/index.xml and find_posts
+post_template = ' '.join(('<post', 'id="%(id)d"', 'md5="%(md5)s"',
+    'tags=%(tags)s', 'score="%(score)d"', 'rating="%(rating)s"',
+    'width="%(width)d"', 'height="%(height)d"', 'file_size="%(file_size)d"',
+    'file_url="http://danbooru.donmai.us/data/%(md5)s.jpg"',
+    'preview_url="http://danbooru.donmai.us/data/preview/%(md5)s.jpg"',
+    'created_at="2007-09-12 21:40:%(second)02d"', 'creator_id="%(creator)d"',
+    'author="someone"', 'source="http://example.com/%(id)d.jpg"',
+    'parent_id=""', 'has_children="false"', 'status="active"',
+    'change="%(id)d"/>'))
+
+
+def post_values(id):
+    '''The attributes of a synthetic post for post_template'''
+    tags = ' '.join(['tag_%d' % ((id * k) % 997,) for k in range(1, 25)])
+    return {'id': id, 'md5': md5(str(id)).hexdigest(), 'score': id % 13,
+        'tags': quoteattr(tags + ' cat_ears "quoted" &amp'),
+        'rating': 'sqe'[id % 3], 'width': 800 + id % 600,
+        'height': 600 + id % 400, 'file_size': 100000 + id * 7,
+        'second': id % 60, 'creator': id % 5000}
+
+
+def posts_xml(posts):
+    return '<?xml version="1.0" encoding="UTF-8"?>\n<posts count="%d" \
+offset="0">\n%s\n</posts>\n' % (len(posts), '\n'.join(posts))
+
+
+def posts_fixture(count, first=1):
+    '''Make an api response with count posts in it'''
+    return posts_xml([post_template % post_values(id) \
+        for id in xrange(first, first+count)])
+
+
+def file_body(id, size):
+    '''The contents of a synthetic post's file (between half and one and a
+    half times size long)'''
+    length = size // 2 + (id * 7919) % (size or 1)
+    return ('%07d ' % (id,) * (length // 8 + 1))[:length]
+
+
+class MockHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''Answers post/index.xml, find_posts and file requests for the posts of
+    a MockServer'''
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        mock = self.server
+        if mock.latency:
+            sleep(mock.latency)
+        if random.random() < mock.errors:
+            return self.reply(503, 'try again', [('Retry-After', '0')])
+        scheme, host, path, query, fragment = urlsplit(self.path)
+        query = dict(parse_qsl(query))
+        if path.endswith('post/index.xml'):
+            tags = query.get('tags', '').split()
+            ids = range(mock.count, 0, -1)
+            for tag in tags:
+                if tag.startswith('id:>'):
+                    ids = [id for id in ids if id > int(tag[4:])]
+            if 'order:id' in tags:
+                ids.reverse()
+            offset = int(query.get('offset', 0))
+            limit = min(int(query.get('limit', 100)), 100)
+            self.reply(200, mock.posts(ids[offset:offset+limit]))
+        elif path.endswith('find_posts'):
+            hashes = query.get('md5', '').split(',')
+            self.reply(200, mock.posts([mock.ids[hash] for hash in hashes \
+                if hash in mock.ids]))
+        else:
+            name = os.path.splitext(os.path.basename(path))[0]
+            if name not in mock.ids:
+                return self.reply(404, 'not found')
+            body = mock.body(mock.ids[name])
+            start = self.headers.get('Range', 'bytes=0-')[6:].split('-')[0]
+            start = int(start or 0)
+            if not start:
+                return self.reply(200, body)
+            headers = [('Content-Range', 'bytes %d-%d/%d' % (start,
+                len(body) - 1, len(body)))]
+            self.reply(206, body[start:], headers)
+
+    def reply(self, code, body, headers=()):
+        '''Send a response, no faster than the server's bandwidth'''
+        self.send_response(code)
+        for header in headers:
+            self.send_header(*header)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        bandwidth, block = self.server.bandwidth, 2 ** 14
+        for i in xrange(0, len(body), block):
+            self.wfile.write(body[i:i+block])
+            if bandwidth:
+                sleep(float(len(body[i:i+block])) / bandwidth)
+
+
+class MockServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''A stand-in for danbooru's api and file server on a free local port,
+    with count posts of files of about size bytes; every request waits for
+    latency seconds, bodies are sent at bandwidth bytes per second (per
+    connection, 0 for no limit) and errors is the chance of a 503 answer'''
+
+    daemon_threads = True
+
+    def __init__(self, count=500, size=2 ** 15, latency=0, bandwidth=0,
+            errors=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), MockHandler)
+        self.count, self.size = count, size
+        self.latency, self.bandwidth, self.errors = latency, bandwidth, errors
+        self.hashes = dict((id, md5(self.body(id)).hexdigest()) \
+            for id in xrange(1, count+1))
+        self.ids = dict((hash, id) for id, hash in self.hashes.iteritems())
+        self.url = 'http://127.0.0.1:%d/' % (self.server_address[1],)
+
+    def body(self, id):
+        return file_body(id, self.size)
+
+    def posts(self, ids):
+        '''An api response with these posts in it'''
+        posts = []
+        for id in ids:
+            values = post_values(id)
+            values.update(md5=self.hashes[id], file_size=len(self.body(id)))
+            posts.append(post_template % values)
+        return posts_xml(posts)
+
+    def start(self):
+        server = threading.Thread(target=self.serve_forever)
+        server.setDaemon(True)
+        server.start()
+        return self
+
+    def handle_error(self, request, client_address):
+        # Clients hanging up mid-response are part of the job
+        pass
+
+
+def make_robot(folder, *argv):
+    '''A Robot that keeps its settings and database in folder'''
+    danbooru.Robot.settings_filename = os.path.join(folder, 'settings')
+    danbooru.Robot.db_filename = os.path.join(folder, 'db')
+    options, args, parser = danbooru.parse_options(list(argv))
+    return danbooru.make_robot(options, args)
+
+
+def mock_robot(folder, mock, *argv):
+    '''A Robot that talks to a MockServer (directly, whatever the proxy
+    settings) and downloads to folder/posts'''
+    robot = make_robot(folder, '--api', mock.url, '--file-server',
+        mock.url + 'data/', *argv)
+    robot.http.proxies = {}
+    robot.folder = os.path.join(folder, 'posts')
+    return robot
+
+
+def quietly(function, *args):
+    '''Call function with its output thrown away'''
+    streams = sys.stdout, sys.stderr
+    sys.stdout = sys.stderr = StringIO()
+    try:
+        return function(*args)
+    finally:
+        sys.stdout, sys.stderr = streams
+
+
+def timed(function, *args):
+    '''Call function quietly; returns the seconds it took'''
+    start = time()
+    quietly(function, *args)
+    return time() - start
+
+
+def minidom_data(source, elementname, keyname):
+    '''Robot.get_data as it was before the streaming parser'''
+    data = minidom.parse(source)
+    results = {}
+    for server in data.getElementsByTagName(elementname):
+        attributes = dict(server.attributes.items())
+        results[int(attributes.pop(keyname))] = attributes
+    data.unlink()
+    return results
+
+
+def streaming_data(source, elementname, keyname):
+    return dict(danbooru.parse_data(source, elementname, keyname))
+
+
+def measure(function, repeat):
+    '''Best time of repeat calls'''
+    best = None
+    for i in xrange(repeat):
+        start = time()
+        function()
+        elapsed = time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_parse():
+    '''minidom against the streaming parser on api responses'''
+    for count, repeat in ((100, 50), (1000, 10), (10000, 3)):
+        fixture = posts_fixture(count)
+        expected = minidom_data(StringIO(fixture), 'post', 'id')
+        assert streaming_data(StringIO(fixture), 'post', 'id') == expected
+        for name, parser in (('minidom', minidom_data),
+                ('streaming', streaming_data)):
+            elapsed = measure(lambda: parser(StringIO(fixture), 'post', 'id'),
+                repeat)
+            values = (count, name, elapsed * 1000, count / elapsed)
+            print '%6d posts  %-10s %9.2f ms  %9d posts/s' % values
+
+
+def legacy_db(filename, rows, page):
+    '''The string-formatted, one execute per row database code that came
+    before the parameterized one'''
+    db = sqlite3.connect(filename)
+    db.execute('''CREATE TABLE IF NOT EXISTS content (id INTEGER PRIMARY KEY, \
+md5 TEXT, tags TEXT, misc BLOB);''')
+    start = time()
+    for i in xrange(0, len(rows), page):
+        for id, post in rows[i:i+page]:
+            post = dict(post)
+            values = (id, post.pop('md5'), post.pop('tags'), pickle.dumps(post))
+            db.execute('''INSERT OR IGNORE into content (id, md5, tags, misc) \
+values (%d, "%s", "%s", "%s");''' % values)
+        db.commit()
+    inserted = time() - start
+    return db, inserted
+
+
+def bench_db():
+    '''inserting and looking up a million posts in the local database'''
+    count, page, batch_size = 10 ** 6, 1000, 100
+    folder = mkdtemp()
+    try:
+        rows = [(id, {'md5': md5(str(id)).hexdigest(), 'tags': 'tag_%d tag_%d' \
+            % (id % 997, id % 13), 'rating': 'sqe'[id % 3]}) \
+            for id in xrange(1, count+1)]
+        hashes = [post['md5'] for id, post in rows]
+        batches = [dict(('file%d' % (i,), hash) for i, hash \
+            in enumerate(hashes[j:j+batch_size])) \
+            for j in xrange(0, count, batch_size)]
+        # Every lookup scans the table, so the legacy code only gets a sample
+        # of 50 batches spread over the whole id range
+        samples = [dict(('file%d' % (id,), hashes[id]) \
+            for id in xrange(i, count, count // batch_size)) \
+            for i in xrange(50)]
+        db, inserted = legacy_db(os.path.join(folder, 'legacy'), rows, page)
+        start = time()
+        for batch in samples:
+            values = '","'.join(batch.values())
+            db.execute('''SELECT md5, id FROM content WHERE md5 IN ("%s");''' \
+                % (values,)).fetchall()
+        looked_up = time() - start
+        db.close()
+        print '%-10s %8.2f s insert  %8.2f ms per md5 batch lookup' % \
+            ('legacy', inserted, looked_up * 1000 / len(samples))
+        for name in ('current', 'bulk'):
+            os.mkdir(os.path.join(folder, name))
+            robot = make_robot(os.path.join(folder, name))
+            if name == 'bulk':
+                # What the inserts cost without the md5 index to keep up
+                robot.cur.execute('DROP INDEX content_md5;')
+            start = time()
+            for i in xrange(0, count, page):
+                robot.update_db(dict(rows[i:i+page]))
+                robot.db.commit()
+            inserted = time() - start
+            if name == 'bulk':
+                start = time()
+                robot.cur.execute('''CREATE INDEX content_md5 ON content \
+(md5, present);''')
+                robot.db.commit()
+                print '%-10s %8.2f s insert  %8.2f s to index md5 afterwards' \
+                    % (name, inserted, time() - start)
+            else:
+                start = time()
+                for batch in batches:
+                    assert not robot.filter_hashes(batch)
+                looked_up = time() - start
+                values = (name, inserted, looked_up * 1000 / len(batches),
+                    looked_up, count)
+                print '%-10s %8.2f s insert  %8.2f ms per md5 batch lookup \
+(%.2f s for all %d)' % values
+            robot.db.close()
+            robot.settings.close()
+    finally:
+        shutil.rmtree(folder)
+
+
+def files_fixture(count):
+    '''A dict of filename: hash for count files in 100 folders, a tenth of
+    them duplicates; returns it with posts for every other hash'''
+    unique = count - count // 10
+    hashes = dict(('folder_%d/%x.jpg' % (i % 100, i),
+        md5(str(i % unique)).hexdigest()) for i in xrange(count))
+    posts = dict((i + 1, {'md5': md5(str(i)).hexdigest(), 'tags': 'tag'}) \
+        for i in xrange(0, unique, 2))
+    return hashes, posts
+
+
+def legacy_filter(hashes, query):
+    '''Robot.filter_hashes as it was before the reverse index'''
+    for hash in query:
+        hash, id = hash
+        for key, value in hashes.copy().iteritems():
+            if hash != value: continue
+            del hashes[key]
+    return hashes
+
+
+def legacy_renames(robot, hashes, query):
+    '''The renames fix_filenames worked out before plan_renames (with a set
+    standing in for the files on disk)'''
+    query, names, plan = dict(query), set(hashes), []
+    for filename, hash in hashes.items():
+        if hash not in query.keys():
+            continue
+        folder, oldname, ext = robot.split_path(filename)
+        newname = '%07d_%s%s' % (query[hash], hash, ext)
+        newname = os.path.join(folder, newname)
+        if filename == newname:
+            continue
+        if newname in names:
+            plan.append((filename, None))
+        else:
+            names.add(newname)
+            plan.append((filename, newname))
+    return plan
+
+
+def bench_files():
+    '''finding known files and planning renames in 10k, 100k and 1M files'''
+    folder = mkdtemp()
+    try:
+        robot = make_robot(folder)
+        for count in (10 ** 4, 10 ** 5, 10 ** 6):
+            hashes, posts = files_fixture(count)
+            robot.cur.execute('DELETE FROM content')
+            robot.update_db(posts)
+            robot.db.commit()
+            query = list(robot.select_in(robot.by_md5_command,
+                set(hashes.itervalues())))
+            start = time()
+            left = robot.filter_hashes(dict(hashes))
+            filtered = time() - start
+            start = time()
+            plan = robot.plan_renames(hashes, dict(query))
+            planned = time() - start
+            values = (count, 'current', filtered, planned, len(left), len(plan))
+            print '%7d files  %-8s %8.2f s filter  %8.2f s renames  \
+(%d unknown, %d renames)' % values
+            # The quadratic versions only get to try the smallest set
+            if count > 10 ** 4: continue
+            start = time()
+            assert legacy_filter(dict(hashes), query) == left
+            filtered = time() - start
+            start = time()
+            legacy = legacy_renames(robot, hashes, query)
+            # Which of the duplicates gets renamed depends on dict order
+            assert sorted(new for old, new in legacy) == \
+                sorted(new for old, new in plan)
+            planned = time() - start
+            values = (count, 'legacy', filtered, planned)
+            print '%7d files  %-8s %8.2f s filter  %8.2f s renames' % values
+        robot.db.close()
+        robot.settings.close()
+    finally:
+        shutil.rmtree(folder)
+
+
+def bench_mock():
+    '''downloading, cataloguing and renaming the posts of a MockServer'''
+    count, size, latency, bandwidth = 300, 2 ** 15, .02, 2 ** 21
+    runs = (('1 thread', 0, ('-t', '1')), ('4 threads', 0, ('-t', '4')),
+        ('4 threads, 5% errors', .05, ('-t', '4')),
+        ('8 threads, 10% errors', .1, ('-t', '8', '--per-host', '8')),
+        ('4 threads, --sync', 0, ('-t', '4', '-S')))
+    for name, errors, argv in runs:
+        mock = MockServer(count, size, latency, bandwidth, errors).start()
+        folder, robot = mkdtemp(), None
+        try:
+            robot = mock_robot(folder, mock, '-l', str(count), '--retries', '8',
+                'benchmark', *argv)
+            elapsed = timed(robot.retrieve_content)
+            files = robot.get_filenames(robot.folder)
+            bits = sum(os.path.getsize(item) for item in files)
+            values = ('retrieve', name, len(files), len(files) / elapsed,
+                bits / 2. ** 20 / elapsed)
+            print '%-9s %-27s %5d files %8.1f files/s %6.2f MiB/s' % values
+            if name != '4 threads': continue
+            # Hide the names and forget the posts for catalogue and fix
+            for i, item in enumerate(files):
+                os.rename(item, os.path.join(robot.folder, '%d.jpg' % (i,)))
+            robot.cur.execute('DELETE FROM content')
+            robot.commit()
+            for task in ('catalogue', 'fix'):
+                function = robot.catalogue_content if task == 'catalogue' \
+                    else robot.fix_filenames
+                elapsed = timed(function, robot.folder)
+                values = (task, name, len(files), len(files) / elapsed)
+                print '%-9s %-27s %5d files %8.1f files/s' % values
+            assert sorted(os.listdir(robot.folder)) == \
+                sorted(os.path.basename(item) for item in files)
+        finally:
+            if robot:
+                robot.db.close()
+                robot.settings.close()
+            mock.shutdown()
+            mock.server_close()
+            shutil.rmtree(folder)
+
+
+benchmarks = [('parse', bench_parse), ('db', bench_db), ('files', bench_files),
+    ('mock', bench_mock)]
+
+
+def main():
+    names = sys.argv[1:] or [name for name, function in benchmarks]
+    for name, function in benchmarks:
+        if name not in names: continue
+        print '%s: %s' % (name, function.__doc__)
+        function()
+
+
+if __name__ == '__main__':
+    main()
@@ -4,7 +4,7 @@
 danbooru.py (http://untu.ms/danbooru/)
 ======================================
 A content retrieval tool for danbooru (http://danbooru.donmai.us/). The
-requirements are Python 2.5 (http://python.org/) and a little console-fu.
+requirements are Python 2.6 (http://python.org/) and a little console-fu.
 
 usage examples
 ==============
@@ -21,6 +21,27 @@ usage examples
    id, refers to the -i or --no-last-id option), ignore whether the file
    exists in the local database (-n or --no-db), and use server 8 (-s or
    --server option, use -L or --list to see a list of available servers)
+ * danbooru.py -t 8 --per-host 4 "suzumiya haruhi"
+   Download content tagged suzumiya_haruhi with up to 8 files at once (-t or
+   --threads), but no more than 4 from the same host (--per-host)
+ * danbooru.py -Q negima -r safe -- -cat_ears
+   List the posts in the local database (-Q or --local) that are tagged
+   negima and rated safe, but not tagged cat_ears
+ * danbooru.py -S negima
+   Download only the posts tagged negima that are newer than the last ones
+   synced (-S or --sync), paging by id instead of offset
+ * danbooru.py -S -t 4 -b queries.txt
+   Sync every query listed in queries.txt (-b or --batch, one "tags" or
+   "folder: tags" per line) in one go; posts that match more than one
+   query are downloaded once and hardlinked into the other folders
+ * danbooru.py --store ~/store -x * negima
+   Fix the filenames in all subfolders and move the files into a store
+   (--store) where each one is kept once, leaving hardlinks in the folders;
+   then download negima into the store and link it into the negima folder
+ * danbooru.py -M -l 100000 && danbooru.py -O -e negima
+   Mirror the metadata of up to 100000 posts into the local database (-M or
+   --mirror), then list the ones tagged negima that aren't downloaded yet
+   from it (-O or --offline, -e or --simulate), without asking the api
  * danbooru.py -c * -x *
    Catalogue (-c or --catalogue) and rename (-x or --fix) all files in all
    subfolders in the current path
@@ -41,16 +62,42 @@ to the public domain.
 
 import re
 import os
+import sys
+import errno
+import shutil
+import atexit
+import json
+import socket
 import urllib
+import httplib
+import threading
 import shelve
 import sqlite3
 import pickle
+import random
+import cProfile
+import pstats
 
 from glob import glob, iglob
 from hashlib import md5
+from heapq import heappush, heappop
+from multiprocessing import Pool, cpu_count
+from Queue import Queue, Empty
+from urlparse import urlsplit, urljoin, parse_qsl
 from sys import platform, stderr
 from time import time
-from xml.dom import minidom
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+try:
+    from xml.etree.cElementTree import iterparse
+except ImportError:
+    from xml.etree.ElementTree import iterparse
 
 # time.clock is more granual than time.time on win32
 if platform == 'win32':
@@ -64,13 +111,670 @@ __build__ = '%build%'
 
 case = lambda count, word: word if count == 1 else word + 's'
 cases = lambda count, singular, plural: singular if count == 1 else plural
+to_unicode = lambda value: value if isinstance(value, unicode) \
+    else unicode(str(value), 'utf-8', 'ignore')
+
+
+def parse_data(source, elementname, keyname):
+    '''Parse api xml from a file-like object as it is read, yielding a (key,
+    attributes) pair for every element as soon as it has been closed'''
+    events = iterparse(source, ('start', 'end'))
+    event, root = events.next()
+    for event, element in events:
+        if event != 'end' or element.tag != elementname:
+            continue
+        attributes = dict(element.attrib)
+        # Drop the finished elements so the tree never grows past one post
+        root.clear()
+        yield int(attributes.pop(keyname)), attributes
+
+
+def pack_misc(attributes):
+    '''Encode the post attributes that have no column as a query string'''
+    return urllib.urlencode(sorted([(key, to_unicode(value).encode('utf-8')) \
+        for key, value in attributes.iteritems()]))
+
+
+def unpack_misc(text):
+    '''Decode what pack_misc() made'''
+    return dict([(key, unicode(value, 'utf-8', 'ignore')) \
+        for key, value in parse_qsl(str(text or ''), True)])
+
+
+def hash_stream(source, hash=None, blocksize=2 ** 20, length=None):
+    '''Feed the rest of a file object (or only length bytes of it) to an
+    md5, blocksize bytes at a time'''
+    hash = hash or md5()
+    if length is None:
+        for block in iter(lambda: source.read(blocksize), ''):
+            hash.update(block)
+        return hash
+    while length > 0:
+        block = source.read(min(blocksize, length))
+        if not block: break
+        hash.update(block)
+        length -= len(block)
+    return hash
+
+
+def hash_file(filename):
+    '''Get the md5 of a file without reading all of it into memory'''
+    with open(filename, 'rb') as source:
+        return filename, hash_stream(source).hexdigest()
+
+
+def index_hashes(hashes):
+    '''Turn a dict of filename: hash around into one of hash: [filenames]'''
+    index = {}
+    for filename, hash in hashes.iteritems():
+        index.setdefault(hash, []).append(filename)
+    return index
+
+
+def link_file(source, destination):
+    '''Hardlink destination to source, or symlink it where hardlinks can't be
+    made (another filesystem, no os.link); returns whether either worked'''
+    for link in (getattr(os, 'link', None), getattr(os, 'symlink', None)):
+        if not link: continue
+        try:
+            link(os.path.abspath(source), destination)
+        except OSError:
+            continue
+        return True
+    return False
+
+
+def move_file(source, destination):
+    '''Rename source to destination, or copy it over and remove it if they
+    are on different filesystems'''
+    try:
+        os.rename(source, destination)
+    except OSError, e:
+        if e.errno != errno.EXDEV: raise
+        shutil.move(source, destination)
+
+
+def load_fallocate():
+    '''posix_fallocate from the C library through ctypes (os doesn't have
+    it in Python 2), or None where there is no such function'''
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'))
+        function = getattr(libc, 'posix_fallocate64', None) or \
+            libc.posix_fallocate
+    except (ImportError, OSError, AttributeError, TypeError):
+        return None
+    function.argtypes = (ctypes.c_int, ctypes.c_int64, ctypes.c_int64)
+    function.restype = ctypes.c_int
+
+    def posix_fallocate(fd, offset, length):
+        # Returns the error number instead of setting errno
+        error = function(fd, offset, length)
+        if error:
+            raise OSError(error, os.strerror(error))
+    return posix_fallocate
+
+posix_fallocate = load_fallocate()
+
+
+def poll(queue, refresh=.5):
+    '''Get the next item from a queue, waking up every refresh seconds so
+    KeyboardInterrupt isn't blocked while waiting'''
+    while True:
+        try:
+            return queue.get(True, refresh)
+        except Empty:
+            pass
+
+
+def backoff(attempt, error=None, base=1., cap=60.):
+    '''Seconds to wait before retry number attempt (counting from 0): full
+    jitter over an exponentially growing window, or longer if the server asked
+    for it with Retry-After'''
+    delay = random.uniform(0, min(cap, base * 2 ** attempt))
+    return max(delay, getattr(error, 'retry_after', 0) or 0)
+
+
+def retryable(error):
+    '''Whether a failure is worth trying again later (anything but a file
+    that keeps failing its md5 check, or a 4xx other than 429 Too Many
+    Requests)'''
+    if isinstance(error, IntegrityError):
+        return False
+    code = getattr(error, 'code', None)
+    return not isinstance(error, HTTPError) or code == 429 or code >= 500
+
+
+class HTTPError(IOError):
+    '''The server answered with an error status'''
+
+    def __init__(self, code, reason, url, retry_after=None):
+        IOError.__init__(self, 'HTTP %d %s' % (code, reason))
+        self.code, self.url = code, url
+        try:
+            self.retry_after = min(float(retry_after), 300.)
+        except (TypeError, ValueError):
+            self.retry_after = None
+
+
+class IntegrityError(IOError):
+    '''A download still didn't match its md5 after being fetched again'''
+
+
+class Throttle(object):
+    '''Paces the requests to one host: a token bucket caps the request rate
+    (unless rate is 0), and the number of transfers at once is limited to a
+    window that halves on 429 and 5xx answers and grows back by one after
+    that many successful ones, up to ceiling'''
+
+    def __init__(self, rate=0, ceiling=2):
+        self.rate, self.burst = rate, max(rate, 1)
+        self.tokens, self.stamp = self.burst, xtime()
+        self.limit = self.ceiling = ceiling
+        self.active, self.successes = 0, 0
+        self.condition = threading.Condition()
+
+    def take(self):
+        '''Wait for the token bucket to allow another request'''
+        if not self.rate:
+            return
+        with self.condition:
+            while True:
+                now = xtime()
+                self.tokens = min(self.burst,
+                    self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                self.condition.wait((1 - self.tokens) / self.rate)
+
+    def feedback(self, status):
+        '''Adapt the concurrency window to a response status'''
+        with self.condition:
+            if status == 429 or status >= 500:
+                self.limit = max(1, self.limit // 2)
+                self.successes = 0
+            elif status < 400 and self.limit < self.ceiling:
+                self.successes += 1
+                if self.successes >= self.limit:
+                    self.limit += 1
+                    self.successes = 0
+                    self.condition.notifyAll()
+
+    def __enter__(self):
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
 
+    def __exit__(self, *info):
+        with self.condition:
+            self.active -= 1
+            self.condition.notifyAll()
 
-# Identify as danbooru.py/0.x (change this if you want to go ninja)
-class Opener(urllib.FancyURLopener):
+    def rest(self, seconds):
+        '''Sleep inside a with block without holding a place in the window'''
+        self.__exit__()
+        try:
+            sleep(seconds)
+        finally:
+            self.__enter__()
+
+
+class RetryQueue(object):
+    '''Keeps failed work aside until its backoff has passed, giving up after
+    a number of attempts'''
+
+    def __init__(self, attempts=5):
+        self.attempts = attempts
+        self.heap = []
+
+    def __len__(self):
+        return len(self.heap)
+
+    def put(self, key, item, error, attempt=1):
+        '''Schedule another try; returns False if it's not worth one'''
+        if attempt > self.attempts or not retryable(error):
+            return False
+        heappush(self.heap, (time() + backoff(attempt, error), key, item,
+            attempt))
+        return True
+
+    def due(self):
+        '''Take out everything that may be tried now, as {key: (item,
+        attempt)}'''
+        results = {}
+        while self.heap and self.heap[0][0] <= time():
+            when, key, item, attempt = heappop(self.heap)
+            results[key] = item, attempt
+        return results
+
+    def keys(self):
+        return [key for when, key, item, attempt in self.heap]
+
+    def wait(self):
+        '''Sleep until the next item is due'''
+        if self.heap:
+            sleep(max(0, self.heap[0][0] - time()))
+
+
+class Metrics(object):
+    '''Adds up how often each stage of a run (api, parse, filter, download,
+    network, write, hash, commit) happens, how long it takes and how many
+    bytes and items go through it; any thread can record'''
+
+    # Upper bounds of the latency histogram buckets, in seconds
+    buckets = (.005, .025, .1, .5, 2.5, 10.)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.started = time()
+
+    def record(self, stage, seconds, bytes=0, items=1):
+        with self.lock:
+            if stage not in self.stages:
+                self.stages[stage] = {'calls': 0, 'items': 0, 'bytes': 0,
+                    'seconds': 0., 'max': 0., 'buckets': [0] * len(self.buckets)}
+            totals = self.stages[stage]
+            totals['calls'] += 1
+            totals['items'] += items
+            totals['bytes'] += bytes
+            totals['seconds'] += seconds
+            totals['max'] = max(totals['max'], seconds)
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    totals['buckets'][i] += 1
+
+    def get(self, stage):
+        '''A copy of a stage's totals, or None if it never happened'''
+        with self.lock:
+            if stage in self.stages:
+                return dict(self.stages[stage])
+
+    def write(self, filename):
+        '''Append the totals to a JSON lines log, or replace a Prometheus text
+        file with them if the filename ends in .prom'''
+        with self.lock:
+            stages = sorted((stage, dict(totals, buckets=list(totals['buckets'])))
+                for stage, totals in self.stages.iteritems())
+        if filename.endswith('.prom'):
+            with open(filename + '.tmp', 'w') as output:
+                output.write(self.prometheus(stages))
+            if os.path.exists(filename) and platform == 'win32':
+                os.remove(filename)
+            os.rename(filename + '.tmp', filename)
+            return
+        now = time()
+        with open(filename, 'a') as output:
+            for stage, totals in stages:
+                totals.update(stage=stage, time=now, run=now - self.started,
+                    buckets=zip(self.buckets, totals['buckets']))
+                output.write(json.dumps(totals, sort_keys=True) + '\n')
+
+    def prometheus(self, stages):
+        '''The totals in Prometheus' text format'''
+        lines = ['# HELP danbooru_stage_seconds Time spent in each stage',
+            '# TYPE danbooru_stage_seconds histogram']
+        for stage, totals in stages:
+            for bound, count in zip(self.buckets, totals['buckets']):
+                lines.append('danbooru_stage_seconds_bucket{stage="%s",le="%s"} \
+%d' % (stage, bound, count))
+            lines.append('danbooru_stage_seconds_bucket{stage="%s",le="+Inf"} \
+%d' % (stage, totals['calls']))
+            lines.append('danbooru_stage_seconds_sum{stage="%s"} %f' % (stage,
+                totals['seconds']))
+            lines.append('danbooru_stage_seconds_count{stage="%s"} %d' % (stage,
+                totals['calls']))
+        for name, text in (('bytes', 'Bytes through each stage'),
+                ('items', 'Posts, files or rows through each stage')):
+            lines.append('# HELP danbooru_stage_%s_total %s' % (name, text))
+            lines.append('# TYPE danbooru_stage_%s_total counter' % (name,))
+            for stage, totals in stages:
+                lines.append('danbooru_stage_%s_total{stage="%s"} %d' % (name,
+                    stage, totals[name]))
+        return '\n'.join(lines) + '\n'
+
+
+class Metered(object):
+    '''Wraps a file-like object to count the bytes read from it and the time
+    spent waiting for them'''
+
+    def __init__(self, source):
+        self.source = source
+        self.bytes = 0
+        self.seconds = .0
+
+    def read(self, *args):
+        start = xtime()
+        data = self.source.read(*args)
+        self.seconds += xtime() - start
+        self.bytes += len(data)
+        return data
+
+    def close(self):
+        self.source.close()
+
+
+class Profiler(object):
+    '''Profiles functions with cProfile on any number of threads (each with
+    a profiler of its own, since one only sees the thread it runs on) and
+    saves the stats of all of them as one'''
+
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.profilers = []
+
+    def runcall(self, function, *args):
+        profiler = getattr(self.local, 'profiler', None)
+        if profiler is None:
+            profiler = self.local.profiler = cProfile.Profile()
+            with self.lock:
+                self.profilers.append(profiler)
+        return profiler.runcall(function, *args)
+
+    def dump_stats(self, filename):
+        with self.lock:
+            profilers = list(self.profilers)
+        if not profilers:
+            return
+        stats = pstats.Stats(profilers[0])
+        for profiler in profilers[1:]:
+            stats.add(profiler)
+        stats.dump_stats(filename)
+
+
+class HTTPPool(object):
+    '''Keeps HTTP/1.1 connections alive between requests, with a pool of idle
+    connections for every host'''
+
+    # Identify as danbooru.py/0.x (change this if you want to go ninja)
     #~ version = 'danbooru.py/%s' % (__version__,)
     version = 'telnet 80'
-urllib._urlopener = Opener()
+    redirects = 5
+    retries = 3
+    # Downloads are written buffer bytes at a time, and fsynced after every
+    # fsync bytes and before they're put in place (unless fsync is 0)
+    buffer = 2 ** 20
+    fsync = 0
+
+    def __init__(self, timeout=30, size=8, rate=0, per_host=2, metrics=None):
+        self.timeout = timeout
+        self.metrics = metrics or Metrics()
+        self.size = size
+        self.rate, self.per_host = rate, per_host
+        self.idle = {}
+        self.throttles = {}
+        self.lock = threading.Lock()
+        self.proxies = urllib.getproxies()
+
+    def throttle(self, host):
+        '''Get the Throttle that paces requests to a host'''
+        with self.lock:
+            if host not in self.throttles:
+                self.throttles[host] = Throttle(self.rate, self.per_host)
+            return self.throttles[host]
+
+    def route(self, url):
+        '''Get the (scheme, host) to connect to and the path to request'''
+        scheme, host, path, query, fragment = urlsplit(url)
+        path = (path or '/') + ('?' + query if query else '')
+        proxy = self.proxies.get(scheme)
+        if scheme == 'http' and proxy and not urllib.proxy_bypass(host):
+            return tuple(urlsplit(proxy)[:2]), url
+        return (scheme, host), path
+
+    def checkout(self, key):
+        '''Get an idle connection to a host, or a new one'''
+        with self.lock:
+            idle = self.idle.get(key)
+            if idle:
+                return idle.pop(), True
+        scheme, host = key
+        connection = httplib.HTTPSConnection if scheme == 'https' \
+            else httplib.HTTPConnection
+        return connection(host, timeout=self.timeout), False
+
+    def checkin(self, key, connection):
+        '''Put a connection back in the pool (or close it if it's full)'''
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.size:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def request(self, key, path, headers):
+        '''Send a GET, retrying once on a fresh connection if a kept-alive
+        one turns out to have been closed by the server'''
+        while True:
+            connection, reused = self.checkout(key)
+            try:
+                connection.request('GET', path, headers=headers)
+                return connection, connection.getresponse()
+            except (httplib.HTTPException, socket.error), e:
+                connection.close()
+                if reused:
+                    continue
+                if isinstance(e, IOError):
+                    raise
+                raise IOError('http error', str(e) or e.__class__.__name__)
+
+    def open(self, url, headers=None):
+        '''Get a file-like response for url, following redirects'''
+        headers = dict(headers or {})
+        headers['User-Agent'] = self.version
+        for i in xrange(self.redirects + 1):
+            key, path = self.route(url)
+            throttle = self.throttle(urlsplit(url)[1])
+            throttle.take()
+            connection, response = self.request(key, path, headers)
+            response = Response(self, key, connection, response)
+            throttle.feedback(response.status)
+            location = response.getheader('location')
+            if response.status in (301, 302, 303, 307) and location:
+                response.drain()
+                url = urljoin(url, location)
+                continue
+            if response.status >= 400:
+                response.drain()
+                raise HTTPError(response.status, response.reason, url,
+                    response.getheader('retry-after'))
+            return response
+        raise IOError('http error', 'too many redirects (%s)' % (url,))
+
+    def retrieve(self, url, destination, reporthook=None, blocksize=2 ** 16,
+            size=None, hash=None, pause=sleep):
+        '''Like urllib.urlretrieve, but over a pooled connection. The data goes
+        to a .part file, preallocated to size, that is resumed with Range
+        requests (now and by later calls, while its .journal still expects the
+        same size and md5, and says how much of it has been written) and
+        hashed as it is written. It is only renamed into place once its md5
+        checks out; a mismatch is downloaded again, and if it keeps happening
+        the file is put aside as .bad and IntegrityError raised. pause is
+        called with the seconds to wait before retrying a failed request'''
+        start = xtime()
+        part, journal = destination + '.part', destination + '.journal'
+        expected = '%s\n%s\n%s\n' % (url, size or '', hash or '')
+        wanted, offset = self.read_journal(journal)
+        # Journals without an offset can't be trusted to say what's written
+        if not os.path.exists(part) or wanted != expected or offset is None:
+            self.write_journal(journal, expected, 0)
+            self.allocate(part, size)
+        for attempt in xrange(self.retries + 1):
+            last = attempt == self.retries
+            try:
+                read, digest = self.resume(url, part, journal, expected,
+                    reporthook, blocksize)
+            except IOError, e:
+                if last or not retryable(e): raise
+                pause(backoff(attempt, e))
+                continue
+            if os.path.getsize(part) > read:
+                # The api's size was off
+                with open(part, 'r+b') as output:
+                    output.truncate(read)
+            if not hash or digest == hash:
+                break
+            if last:
+                if os.path.exists(destination + '.bad'):
+                    os.remove(destination + '.bad')
+                os.rename(part, destination + '.bad')
+                os.remove(journal)
+                raise IntegrityError('md5 mismatch, expected %s (kept as \
+%s.bad)' % (hash, destination))
+            # Start over from scratch
+            self.write_journal(journal, expected, 0)
+        if self.fsync:
+            with open(part, 'r+b') as output:
+                os.fsync(output.fileno())
+        os.rename(part, destination)
+        os.remove(journal)
+        self.metrics.record('download', xtime() - start, read)
+        return read
+
+    def allocate(self, part, size):
+        '''Make an empty .part that already takes up size bytes (if size is
+        known), so it isn't pieced together all over the disk; where the
+        space can't be reserved, the file only gets its size (and stays
+        sparse)'''
+        size = int(size or 0)
+        with open(part, 'wb') as output:
+            if not size:
+                return
+            if posix_fallocate:
+                try:
+                    posix_fallocate(output.fileno(), 0, size)
+                    return
+                except OSError:
+                    # Not supported by this filesystem
+                    pass
+            output.truncate(size)
+
+    def resume(self, url, part, journal, expected, reporthook, blocksize):
+        '''Write what is missing from a .part file, hashing it on the way, and
+        return its full size and md5; the network is read blocksize bytes at
+        a time, and the file written buffer bytes at a time'''
+        offset = min(self.read_journal(journal)[1], os.path.getsize(part))
+        headers = offset and {'Range': 'bytes=%d-' % (offset,)} or None
+        try:
+            response = self.open(url, headers)
+        except HTTPError, e:
+            # Nothing left to request; the md5 check tells if it's all there
+            if e.code == 416 and offset:
+                with open(part, 'rb') as source:
+                    return offset, hash_stream(source, length=offset).hexdigest()
+            raise
+        waited = 0
+        try:
+            if response.status != 206:
+                offset = 0
+            digest = md5()
+            if offset:
+                # Only what was there before has to be read back
+                with open(part, 'rb') as source:
+                    hash_stream(source, digest, length=offset)
+            length = int(response.getheader('content-length') or -1)
+            size = offset + length if length >= 0 else -1
+            read, blocks, synced = offset, offset // blocksize, offset
+            if reporthook: reporthook(blocks, blocksize, size)
+            with open(part, 'r+b') as output:
+                output.seek(offset)
+                buffered, pending = [], 0
+                while True:
+                    began = xtime()
+                    block = response.read(blocksize)
+                    waited += xtime() - began
+                    if block:
+                        buffered.append(block)
+                        pending += len(block)
+                        digest.update(block)
+                        read += len(block)
+                        blocks += 1
+                        if reporthook: reporthook(blocks, blocksize, size)
+                    if pending and (pending >= self.buffer or not block):
+                        began = xtime()
+                        output.write(''.join(buffered))
+                        output.flush()
+                        if self.fsync and read - synced >= self.fsync:
+                            os.fsync(output.fileno())
+                            synced = read
+                        self.metrics.record('write', xtime() - began, pending)
+                        self.write_journal(journal, expected, read)
+                        buffered, pending = [], 0
+                    if not block: break
+        finally:
+            response.close()
+            self.metrics.record('network', waited, read - offset)
+        if read < size:
+            raise IOError('retrieval incomplete: got only %d out of %d bytes' \
+                % (read, size))
+        return read, digest.hexdigest()
+
+    def read_journal(self, journal):
+        '''Get what a .journal expects of its .part and how much of the .part
+        it says has been written (None for journals from before offsets)'''
+        try:
+            with open(journal) as source:
+                lines = source.read().split('\n')
+        except IOError:
+            return None, None
+        try:
+            offset = int(lines[3])
+        except (IndexError, ValueError):
+            offset = None
+        return '\n'.join(lines[:3]) + '\n', offset
+
+    def write_journal(self, journal, expected, offset):
+        with open(journal, 'w') as output:
+            output.write('%s%d\n' % (expected, offset))
+
+
+class Response(object):
+    '''A response whose connection goes back to the pool once it's read'''
+
+    def __init__(self, pool, key, connection, response):
+        self.pool, self.key = pool, key
+        self.connection, self.response = connection, response
+        self.status, self.reason = response.status, response.reason
+        self.getheader = response.getheader
+
+    def read(self, amount=None):
+        try:
+            data = self.response.read(amount) if amount \
+                else self.response.read()
+        except httplib.HTTPException, e:
+            raise IOError('http error', str(e) or e.__class__.__name__)
+        if self.response.isclosed():
+            self.release()
+        return data
+
+    def drain(self):
+        '''Read what's left of the body and release the connection'''
+        self.read()
+        self.close()
+
+    def release(self):
+        if self.connection is None:
+            return
+        if self.response.will_close:
+            self.connection.close()
+        else:
+            self.pool.checkin(self.key, self.connection)
+        self.connection = None
+
+    def close(self):
+        '''Release the connection, or drop it if the body wasn't read'''
+        if self.connection is None:
+            return
+        if self.response.isclosed():
+            self.release()
+        else:
+            self.connection.close()
+            self.connection = None
 
 
 class ServerIdError(KeyError):
@@ -83,42 +787,107 @@ class Robot(dict):
     posts_path = 'post/index.xml?tags=%(tags)s%(rating)s&limit=\
 %(limit)d&offset=%(offset)d'
     last_id = '+after_id:%d'
+    # Id based paging for --sync: ascending ids after a cursor
+    sync_path = 'post/index.xml?tags=%(tags)s%(rating)s+id:>%(after)d+\
+order:id&limit=%(limit)d'
     rating_path = '+rating:%s'
+    file_server = 'http://s3.amazonaws.com/danbooru/'
+    rating_tag = 'rating:%s'
     servers_path = 'find_servers'
     md5_path = 'find_posts?md5=%s'
     settings_filename = os.path.join(os.path.expanduser('~'), '.danboorudata')
     db_filename = os.path.join(os.path.expanduser('~'), '.danboorudb')
     namepattern = re.compile(r'(?:\d+_)?([a-f\d]{32})')
     idpattern = re.compile(r'(\d+)_[a-f\d]{32}')
+    # Unfinished and quarantined downloads, and links not yet in place
+    leftovers = ('.part', '.journal', '.bad', '.link')
     logfile = 'error.log'
+    # SQLite's default SQLITE_MAX_VARIABLE_NUMBER
+    max_variables = 999
+    pragmas = ('PRAGMA journal_mode=WAL', 'PRAGMA synchronous=NORMAL',
+        'PRAGMA cache_size=-16384', 'PRAGMA temp_store=MEMORY')
+    # Stored as the db's user_version; see upgrade_db()
+    schema_version = 3
+    # Post attributes with columns of their own (the rest go in misc)
+    post_fields = (('width', int), ('height', int), ('file_size', int),
+        ('score', int), ('rating', to_unicode), ('created_at', to_unicode),
+        ('file_url', to_unicode), ('parent_id', int))
+    post_columns = 'id, md5, tags, width, height, file_size, score, rating, \
+created_at, file_url, parent_id, misc'
+    # What the options newer than rating, refresh, nodb and simulate are
+    # when they aren't given (the same as on the command line)
+    defaults = {'threads': 1, 'per_host': 2, 'prefetch': 1, 'timeout': 30,
+        'jobs': cpu_count(), 'rate': 0, 'retries': 5, 'sync': False,
+        'store': None, 'fsync': 0, 'offline': False, 'api_url': None,
+        'file_server': None, 'metrics_file': None, 'profile_file': None}
 
     def __init__(self, args, limit, offset, **kwargs):
+        self.update(self.defaults)
         for key, value in kwargs.iteritems():
             self[key] = value
         self.end = lambda text, start: '%s (%.2fs)' % (text, time()-start)
+        self.metrics, self.stats_written = Metrics(), False
+        self.profiler = Profiler() if self['profile_file'] else None
+        self.api_url = self['api_url'] or self.api_url
+        self.file_server = self['file_server'] or self.file_server
         self.tags = self.parse_tags(args)
         self.settings = self.load_settings()
         #~ self.servers = self.load_servers()
         self.db, self.cur = self.load_db()
+        self.tag_ids = {}
+        self.max_ids = {}
+        self.upgrade_db()
+        self.cache_hits, self.cache_misses = 0, 0
         self.folder = self.tags
         self.limit = limit
         self.offset = offset
-        self.dl = Downloader()
+        self.http = HTTPPool(self['timeout'], max(self['threads'], 2),
+            self['rate'], self['per_host'], self.metrics)
+        self.http.fsync = int(self['fsync'] * 2 ** 20)
+        self.dl = Downloader(http=self.http)
+        self.pool = DownloadPool(self['threads'], self.http, self.profiler) \
+            if self['threads'] > 1 else None
+        self.retry_queue = RetryQueue(self['retries'])
+        self.unfinished = set()
+        # Where the posts of this session went, for linking them elsewhere
+        self.fetched = {}
+        self.linked = 0
 
     def get_last_id(self, pathname):
         '''Get the youngest file by its danbooru id'''
         if self['refresh']:
             return ''
-        filenames = self.get_filenames(pathname)
-        filenames = sorted(filenames)[::-1]
-        for item in filenames:
-            folder, name, ext = self.split_path(item)
-            match = re.match(self.idpattern, name)
+        return self.last_id % (self.get_max_id(pathname) or 1,)
+
+    def get_max_id(self, pathname):
+        '''Get the highest post id in a folder; the settings remember it for
+        as long as the folder's mtime and number of entries stay the same'''
+        key = os.path.abspath(pathname)
+        stored = self.settings.get('max_ids', {}).get(key)
+        # mtimes can be coarse, so a new file doesn't always change it
+        if stored and len(stored) == 3 and \
+                stored[:2] == self.folder_state(pathname):
+            self.max_ids[key] = stored[2]
+            return stored[2]
+        id = 0
+        for item in self.get_filenames(pathname):
+            match = self.idpattern.match(os.path.basename(item))
             if match:
-                id = int(match.group(1).lstrip('0'))
-                break
-        else: id = 1
-        return self.last_id % (int(id),)
+                id = max(id, int(match.group(1)))
+        self.save_max_id(pathname, id)
+        return id
+
+    def save_max_id(self, pathname, id):
+        '''Remember the highest post id in a folder as of its current state'''
+        key = os.path.abspath(pathname)
+        max_ids = self.settings.get('max_ids', {})
+        max_ids[key] = self.folder_state(pathname) + (id,)
+        self.max_ids[key] = id
+        self.save_settings(max_ids=max_ids)
+
+    def folder_state(self, pathname):
+        '''The mtime and number of entries of a folder'''
+        return os.stat(pathname).st_mtime, len(os.listdir(pathname))
 
     def error(self, message):
         print >> stderr, 'Error: %s' % (message,)
@@ -128,70 +897,397 @@ class Robot(dict):
         print 'Downloading to %s...' % (self.folder,)
         if not os.path.exists(self.folder):
             os.mkdir(self.folder)
-        last_id = self.get_last_id(self.folder)
-        step, limit, offset = 100, self.limit, self.offset
-        for i in xrange(offset, limit, step):
-            j = i+step if i+step < limit else limit
-            params = { 'tags': self.tags, 'last_id': last_id, 'limit': j,
-                'offset': i, 'rating': self.rating_path % self['rating'] \
-                    if self['rating'] else ''}
-            path, start = self.posts_path % params, time()
-            url = self.api_url+path
-            print 'API:', path+'...',
-            data = self.get_data(url, 'post', 'id')
-            print self.end('done', start)
+        # Only this query's posts hold back its cursor
+        self.unfinished = set()
+        last_id, top, cursor = self.get_last_id(self.folder), 0, None
+        if self['sync']:
+            cursor = self.get_cursor()
+            print 'Syncing posts after #%d...' % (cursor,)
+        for path, data in self.iter_pages(last_id, cursor):
+            page_top = max(data.keys() or [0])
             if self['nodb'] or not len(data):
                 print '%d posts returned' % (len(data),)
-                if not len(data): break
             else:
                 before = len(data)
                 self.filter_data(data)
                 values = (before, case(before, 'post'),
                     len(data), cases(len(data), 'wasn\'t', 'weren\'t'))
                 print '%d %s returned, %d %s in the local database' % values
-            if self['simulate']: continue
+            if self['simulate']:
+                if self['offline']:
+                    for id in sorted(data):
+                        print '%07d %s' % (id, data[id]['md5'])
+                continue
             if len(data):
-                for key, value in data.iteritems():
-                    self.get_post(key, value)
+                data = self.download(data)
+            data.update(self.retry())
+            if len(data):
+                top = max([top] + data.keys())
             self.update_db(data)
-            self.db.commit()
-            try:
-                if before < step: break
-            except UnboundLocalError, e:
-                print e
-        else:
-            print 'Post limit (%d) met' % (limit,)
+            self.commit()
+            if self['sync']:
+                cursor = max(cursor, page_top)
+                self.save_cursor(cursor)
+        if len(self.retry_queue) and not self['simulate']:
+            data = self.retry(wait=True)
+            if len(data):
+                top = max([top] + data.keys())
+            self.update_db(data)
+            self.commit()
+            if self['sync']:
+                self.save_cursor(cursor)
         if not glob(os.path.join(self.folder, '*')):
             print '%s is empty: removing' % (self.folder,)
             os.rmdir(self.folder)
+        elif top and os.path.abspath(self.folder) in self.max_ids:
+            # Keep the stored id valid for the state the downloads left behind
+            key = os.path.abspath(self.folder)
+            self.save_max_id(self.folder, max(top, self.max_ids[key]))
 
-    def get_post(self, id, post):
-        '''Download an individual post'''
+    def iter_pages(self, last_id, cursor=None):
+        '''Yield the (path, data) of every page of the query as the fetcher
+        gets them; it runs ahead by up to prefetch pages on a thread of its
+        own, or on this one for the local db'''
+        if self['offline']:
+            # The db can't be shared with a thread, and it's quick anyway
+            pages = Queue()
+            self.fetch_pages(pages, last_id, cursor)
+        else:
+            pages = Queue(max(self['prefetch'], 1))
+            fetcher = threading.Thread(target=self.profile,
+                args=(self.fetch_pages, pages, last_id, cursor))
+            fetcher.setDaemon(True)
+            fetcher.start()
+        while True:
+            path, data, elapsed = self.next_page(pages)
+            if path is None:
+                if data:
+                    print 'Post limit (%d) met' % (self.limit,)
+                return
+            print '%s: %s... done (%.2fs)' % ('DB' if self['offline'] else 'API',
+                path, elapsed)
+            yield path, data
+
+    def fetch_pages(self, pages, last_id, cursor=None):
+        '''Fetch pages from the api into a bounded queue; ends with a (None,
+        limit met) item, or an exception if the api couldn't be reached'''
+        try:
+            if self['offline']:
+                limit_met = self.fetch_local_pages(pages, cursor)
+            elif cursor is None:
+                limit_met = self.fetch_offset_pages(pages, last_id)
+            else:
+                limit_met = self.fetch_new_pages(pages, cursor)
+            pages.put((None, limit_met, None))
+        except Exception, e:
+            pages.put((None, e, None))
+
+    def fetch_offset_pages(self, pages, last_id):
+        '''Page through the api by offset; returns whether the limit was met'''
+        step, limit, offset = 100, self.limit, self.offset
+        for i in xrange(offset, limit, step):
+            j = i+step if i+step < limit else limit
+            params = { 'tags': self.tags, 'last_id': last_id, 'limit': j,
+                'offset': i, 'rating': self.rating_path % self['rating'] \
+                    if self['rating'] else ''}
+            path, start = self.posts_path % params, time()
+            data = self.get_data(self.api_url+path, 'post', 'id')
+            pages.put((path, data, time()-start))
+            # A short (or empty) page is the last one
+            if len(data) < step: return False
+        return True
+
+    def fetch_local_pages(self, pages, cursor=None):
+        '''Make the pages the api would return out of the posts in the local
+        db (downloaded or mirrored) that match the query; returns whether the
+        limit was met'''
+        step, start = 100, time()
+        ids = [row[0] for row in self.query_db(self.local_terms())]
+        if cursor is None:
+            # Newest first, like the api
+            ids.reverse()
+            count = self.limit - self.offset
+            ids = ids[self.offset:]
+        else:
+            count = self.limit
+            ids = [id for id in ids if id > cursor]
+        limit_met = len(ids) > count
+        ids = ids[:count]
+        for i in xrange(0, len(ids), step):
+            data = self.load_posts(ids[i:i+step])
+            path = 'posts %d to %d of %d' % (i + 1, i + len(data), len(ids))
+            pages.put((path, data, time()-start))
+            start = time()
+        return limit_met
+
+    def local_terms(self):
+        '''The query as query_db terms'''
+        terms = [urllib.unquote(item) for item in self.tags.split('+') if item]
+        if self['rating']:
+            terms.append(self.rating_tag % (self['rating'],))
+        return terms
+
+    def fetch_new_pages(self, pages, cursor):
+        '''Page through the posts newer than cursor in id order, each page
+        starting after the highest id of the last one (unlike offsets, this
+        costs the server the same at any depth); returns whether the limit
+        was met'''
+        step, count = 100, 0
+        while count < self.limit:
+            params = {'tags': self.tags, 'after': cursor,
+                'limit': min(step, self.limit - count),
+                'rating': self.rating_path % self['rating'] \
+                    if self['rating'] else ''}
+            path, start = self.sync_path % params, time()
+            data = self.get_data(self.api_url+path, 'post', 'id')
+            pages.put((path, data, time()-start))
+            count += len(data)
+            if len(data) < params['limit']: return False
+            cursor = max(data)
+        return True
+
+    def mirror_content(self):
+        '''Copy the metadata of the posts that match the query (or of every
+        post, without tags) into the local db without downloading them, in id
+        order from where the last mirror of the query stopped'''
+        key = self.query_key()
+        cursor = self.settings.get('mirrors', {}).get(key, 0)
+        print 'Mirroring posts after #%d...' % (cursor,)
+        start, count = time(), 0
+        for path, data in self.iter_pages('', cursor):
+            count += len(data)
+            if self['simulate'] or not data: continue
+            self.mirror_posts(data)
+            self.commit()
+            cursor = max([cursor] + data.keys())
+            mirrors = self.settings.get('mirrors', {})
+            mirrors[key] = cursor
+            self.save_settings(mirrors=mirrors)
+        print self.end('%d %s mirrored' % (count, case(count, 'post')), start)
+
+    def query_key(self):
+        '''What a sync cursor is stored under'''
+        return self.tags + (self.rating_path % self['rating'] \
+            if self['rating'] else '')
+
+    def get_cursor(self):
+        '''Get the highest post id synced for the query, or for a query that
+        hasn't been synced yet, the highest id in the folder'''
+        cursors = self.settings.get('cursors', {})
+        if self.query_key() in cursors:
+            return cursors[self.query_key()]
+        return self.get_max_id(self.folder)
+
+    def save_cursor(self, id):
+        '''Store how far the query has been synced; posts that are still
+        waiting for a retry, or ran out of retries, hold the cursor back
+        so the next run gets them again'''
+        pending = self.unfinished.union(self.retry_queue.keys())
+        if pending:
+            id = min(id, min(pending) - 1)
+        if self['simulate']:
+            return
+        cursors = self.settings.get('cursors', {})
+        cursors[self.query_key()] = max(id, cursors.get(self.query_key(), 0))
+        self.save_settings(cursors=cursors)
+
+    def next_page(self, pages):
+        '''Wait for the fetcher (without blocking KeyboardInterrupt)'''
+        page = poll(pages)
+        path, data, elapsed = page
+        if isinstance(data, Exception):
+            raise data
+        return page
+
+    def locate_post(self, id, post):
+        '''Get the remote url and the local name of a post'''
         file_url = post['file_url']
         filename = file_url[file_url.rfind('/')+1:]
         # Figure out the local name (id is padded with zeroes)
         localname = os.path.join(self.folder, '%07d_%s' % (id, filename))
+        #~ server = {'h
+        #~ url = server + '/'.join((filename[0:2], filename[2:4], filename))
+        url = self.file_server + filename
+        return url, localname
+
+    def get_post(self, id, post):
+        '''Download an individual post (returns the error if it fails)'''
+        url, localname = self.locate_post(id, post)
         if os.path.exists(localname):
             self.error('File already exists')
             return
-        #~ server = {'h
-        server = 'http://s3.amazonaws.com/danbooru/'
-        #~ url = server + '/'.join((filename[0:2], filename[2:4], filename))
-        url = server + filename
+        if self.link_post(id, post, localname):
+            print 'Linked %s' % (localname,)
+            return
+        destination = self.destination(post, localname)
         print url
-        print self.dl.retrieve(url, localname, self.exit), \
-            'KiB retrieved in %s' % (self.folder,)
+        try:
+            size = self.dl.retrieve(url, destination, self.exit,
+                post.get('file_size'), post.get('md5'))
+            self.place_post(destination, localname)
+        except (IOError, OSError), e:
+            self.error('%s (%s)' % (e, url))
+            return e
+        print size, 'KiB retrieved in %s' % (self.folder,)
+
+    def get_posts(self, data):
+        '''Download a page of posts; returns the ones that made it and the
+        errors of the ones that didn't'''
+        results, failed = {}, {}
+        if not self.pool:
+            for key, value in data.iteritems():
+                error = self.get_post(key, value)
+                if error:
+                    failed[key] = error
+                else:
+                    results[key] = value
+            return results, failed
+        count, placed = 0, {}
+        for key, value in data.iteritems():
+            url, localname = self.locate_post(key, value)
+            if os.path.exists(localname) or \
+                    self.link_post(key, value, localname):
+                results[key] = value
+                continue
+            destination = self.destination(value, localname)
+            placed[key] = destination, localname
+            self.pool.put(key, url, destination, value.get('file_size'),
+                value.get('md5'))
+            count += 1
+        for key, url, error in self.pool.wait(count, self.exit):
+            if not error:
+                try: self.place_post(*placed[key])
+                except OSError, e:
+                    error = e
+            if error:
+                self.error('%s (%s)' % (error, url))
+                failed[key] = error
+            else:
+                results[key] = data[key]
+        return results, failed
+
+    def blob_path(self, hash, ext):
+        '''Where the content with this hash goes in the store (sharded by the
+        first two bytes of the hash, so no directory gets too big)'''
+        return os.path.join(self['store'], hash[:2], hash[2:4], hash + ext)
+
+    def destination(self, post, localname):
+        '''Where to download a post to: its blob if there's a store, or else
+        straight into the folder'''
+        if not self['store'] or not post.get('md5'):
+            return localname
+        blob = self.blob_path(post['md5'], os.path.splitext(localname)[1])
+        folder = os.path.dirname(blob)
+        if not os.path.isdir(folder):
+            try: os.makedirs(folder)
+            except OSError:
+                # Another thread got there first
+                if not os.path.isdir(folder): raise
+        return blob
+
+    def place_post(self, destination, localname):
+        '''Expose a downloaded blob in the folder it was meant for'''
+        if destination != localname and not link_file(destination, localname):
+            raise OSError('Can\'t link %s to %s' % (destination, localname))
+
+    def link_post(self, id, post, localname):
+        '''Hardlink (or failing that, symlink) a post that is already in the
+        store or that this session put in another folder, instead of
+        downloading it again'''
+        source = self.fetched.get(id)
+        if self['store'] and post.get('md5'):
+            blob = self.blob_path(post['md5'], os.path.splitext(localname)[1])
+            if os.path.exists(blob):
+                source = blob
+        if not source or source == localname or not os.path.exists(source):
+            return False
+        if not link_file(source, localname):
+            return False
+        self.linked += 1
+        return True
+
+    def download(self, data, attempts=None):
+        '''Download posts and put the ones that failed for a reason that may
+        go away in the retry queue; returns the ones that made it'''
+        results, failed = self.get_posts(data)
+        for key, value in results.iteritems():
+            self.fetched.setdefault(key, self.locate_post(key, value)[1])
+        for key, error in failed.iteritems():
+            attempt = (attempts or {}).get(key, 0) + 1
+            if self.retry_queue.put(key, data[key], error, attempt):
+                continue
+            if retryable(error):
+                self.unfinished.add(key)
+            if attempt > 1:
+                self.error('Giving up on post %d after %d %s' % (key,
+                    attempt, cases(attempt, 'try', 'tries')))
+        return results
+
+    def retry(self, wait=False):
+        '''Try again the failed posts whose backoff has passed, or with wait,
+        keep at it until the retry queue is empty'''
+        results = {}
+        while len(self.retry_queue):
+            if wait:
+                self.retry_queue.wait()
+            due = self.retry_queue.due()
+            if due:
+                print 'Retrying %d failed %s...' % (len(due),
+                    case(len(due), 'post'))
+                data = dict([(key, post) for key, (post, attempt) \
+                    in due.iteritems()])
+                attempts = dict([(key, attempt) for key, (post, attempt) \
+                    in due.iteritems()])
+                results.update(self.download(data, attempts))
+            if not wait:
+                break
+        return results
 
     def filter_data(self, data):
         '''Filter out the data that already exists in the local db'''
-        values = '","'.join([str(key) for key in data.keys()])
-        query = self.cur.execute(self.by_id_command % values)
+        start, count = xtime(), len(data)
+        query = self.select_in(self.by_id_command, data.keys())
         for row in query:
             id, = row
-            if id in data:
+            # Posts from earlier in the session still get linked here
+            if id in data and id not in self.fetched:
                 del data[id]
+        self.metrics.record('filter', xtime() - start, items=count)
         return data
 
+    def run_batch(self, filename):
+        '''Run every query in a file in this session, sharing connections,
+        throttles and downloads between them'''
+        try:
+            queries = self.read_batch(filename)
+        except IOError, e:
+            self.error('Can\'t read the batch file (%s)' % (e,))
+            return
+        print 'Running %d %s from %s...' % (len(queries),
+            cases(len(queries), 'query', 'queries'), filename)
+        for folder, tags in queries:
+            self.tags = self.parse_tags(tags)
+            self.folder = folder or self.tags
+            self.retrieve_content()
+        if self.linked:
+            print '%d %s linked instead of downloaded again' % (self.linked,
+                case(self.linked, 'post'))
+
+    def read_batch(self, filename):
+        '''Read queries, one per line: tags separated by spaces, optionally
+        after a "folder:" (lines starting with # are comments)'''
+        queries = []
+        with open(filename) as source:
+            for line in source:
+                tags = line.split()
+                if not tags or tags[0].startswith('#'):
+                    continue
+                folder = None
+                if tags[0].endswith(':'):
+                    folder, tags = tags[0][:-1], tags[1:]
+                queries.append((folder, tags))
+        return queries
+
     def log(self, message):
         '''Unused'''
         print >> open(self.logfile, 'a+'), message
@@ -255,13 +1351,30 @@ class Robot(dict):
     def get_data(self, url, elementname, keyname):
         '''Fetch and parse data from the api (would be many lines longer if \
 this had to be actually spidered)'''
-        data = minidom.parse(urllib.urlopen(url))
-        results = {}
-        for server in data.getElementsByTagName(elementname):
-            attributes = dict(server.attributes.items())
-            results[int(attributes.pop(keyname))] = attributes
-        data.unlink()
-        return results
+        for attempt in xrange(self['retries'] + 1):
+            try:
+                return dict(self.iter_data(url, elementname, keyname))
+            except IOError, e:
+                if attempt == self['retries'] or not retryable(e): raise
+                delay = backoff(attempt, e)
+                self.error('%s, retrying in %.1fs' % (e, delay))
+                sleep(delay)
+
+    def iter_data(self, url, elementname, keyname):
+        '''Fetch data from the api, parsing it while it's being received; the
+        time spent waiting for the api and parsing are recorded apart'''
+        start = xtime()
+        source = Metered(self.http.open(url))
+        opened, count = xtime() - start, 0
+        try:
+            for item in parse_data(source, elementname, keyname):
+                count += 1
+                yield item
+        finally:
+            source.close()
+            waited = opened + source.seconds
+            self.metrics.record('api', waited, source.bytes)
+            self.metrics.record('parse', xtime() - start - waited, items=count)
 
     def get_serverlist(self):
         '''asd'''
@@ -271,22 +1384,6 @@ this had to be actually spidered)'''
         #~ print self.end(start)
         #~ return results
 
-    def get_content_data(self, tags=None, limit=None, offset=None, hashes=None):
-        if tags and limit and offset:
-            url = self.api_url + self.posts_path % (tags, limit, offset)
-            count = limit - offset
-        elif hashes:
-            url = self.api_url + self.md5_path % ','.join(hashes)
-            count = len(hashes)
-        print 'Getting content data for %d %s...' % (count, case(count, 'file')),
-        start = time()
-        results = self.get_data(url, 'post', 'id')
-        print self.end('done', start)
-        if len(results) < count:
-            missing = count - len(results)
-            print '%d %s not found' % (missing, case(missing, 'file'))
-        return results
-
     def parse_tags(self, args):
         '''Parse script arguments'''
         tags = [urllib.quote(item.replace(' ', '_')).replace('%2B', '+') \
@@ -300,24 +1397,318 @@ this had to be actually spidered)'''
         if changes:
             print '%d %s to the local database in this session' % \
                 (changes, case(changes, 'change'))
+        lookups = self.cache_hits + self.cache_misses
+        if lookups:
+            print '%d of %d %s found in the hash cache' % \
+                (self.cache_hits, lookups, cases(lookups, 'hash', 'hashes'))
+        written, network = self.metrics.get('write'), self.metrics.get('network')
+        if written and written['seconds'] and network and network['seconds']:
+            mebi = lambda bits: bits / 2. ** 20
+            values = (mebi(written['bytes']),
+                mebi(written['bytes'] / written['seconds']),
+                mebi(network['bytes'] / network['seconds']))
+            print '%.1f MiB written at %.1f MiB/s, received at %.1f MiB/s \
+per transfer' % values
+        self.write_stats()
         print 'Bye~!'
         exit()
 
+    def write_stats(self):
+        '''Save the metrics and the profile if there are files for them (once
+        per session)'''
+        if self.stats_written:
+            return
+        self.stats_written = True
+        if self['metrics_file']:
+            self.metrics.write(self['metrics_file'])
+            print 'Metrics written to %s' % (self['metrics_file'],)
+        if self.profiler:
+            self.profiler.dump_stats(self['profile_file'])
+            print 'Profile written to %s' % (self['profile_file'],)
+
+    def profile(self, function, *args):
+        '''Run function under cProfile if there's a file to save the stats in
+        (which happens at exit, with the stats of every thread)'''
+        if not self.profiler:
+            return function(*args)
+        return self.profiler.runcall(function, *args)
+
+    def commit(self):
+        start = xtime()
+        self.db.commit()
+        self.metrics.record('commit', xtime() - start)
+
     def load_db(self):
         '''Connect to the sqlite db'''
         self.init_db_command ='''CREATE TABLE IF NOT EXISTS content \
-(id INTEGER PRIMARY KEY, md5 TEXT, tags TEXT, misc BLOB);'''
+(id INTEGER PRIMARY KEY, md5 TEXT, tags TEXT, width INTEGER, height INTEGER, \
+file_size INTEGER, score INTEGER, rating TEXT, created_at TEXT, file_url TEXT, \
+parent_id INTEGER, misc BLOB, present INTEGER NOT NULL DEFAULT 1);'''
+        self.init_md5_index_command = '''CREATE INDEX IF NOT EXISTS \
+content_md5 ON content (md5);'''
         self.update_db_command ='''INSERT OR IGNORE into content \
-(id, md5, tags, misc) values (%d, "%s", "%s", "%s");'''
+(%s) values (%s);''' % (self.post_columns, ', '.join('?' * 12))
+        # Mirrored posts are only metadata until they're downloaded
+        self.mirror_command ='''INSERT OR IGNORE into content \
+(%s, present) values (%s, 0);''' % (self.post_columns, ', '.join('?' * 12))
+        self.mark_present_command = '''UPDATE content SET present = 1 \
+WHERE present = 0 AND id IN (%s);'''
+        self.posts_command = '''SELECT %s FROM content WHERE id IN (%%s);''' \
+            % (self.post_columns,)
         self.by_md5_command ='''SELECT md5, id FROM content \
-WHERE md5 IN ("%s");'''
-        self.by_id_command ='''SELECT id FROM content WHERE id IN ("%s");'''
+WHERE md5 IN (%s);'''
+        self.present_md5_command ='''SELECT md5, id FROM content \
+WHERE present = 1 AND md5 IN (%s);'''
+        self.by_id_command ='''SELECT id FROM content \
+WHERE present = 1 AND id IN (%s);'''
+        self.init_cache_command = '''CREATE TABLE IF NOT EXISTS hashes \
+(path TEXT PRIMARY KEY, size INTEGER, mtime REAL, inode INTEGER, md5 TEXT);'''
+        self.update_cache_command = '''INSERT OR REPLACE INTO hashes \
+(path, size, mtime, inode, md5) VALUES (?, ?, ?, ?, ?);'''
+        self.by_path_command = '''SELECT size, mtime, inode, md5 FROM hashes \
+WHERE path = ?;'''
+        self.all_cached_command = '''SELECT path, size, mtime, inode \
+FROM hashes;'''
+        self.prune_cache_command = '''DELETE FROM hashes WHERE path = ?;'''
+        self.init_tags_command = '''CREATE TABLE IF NOT EXISTS tags \
+(id INTEGER PRIMARY KEY, name TEXT UNIQUE);'''
+        self.init_post_tags_command = '''CREATE TABLE IF NOT EXISTS post_tags \
+(tag_id INTEGER, post_id INTEGER, PRIMARY KEY (tag_id, post_id));'''
+        self.add_tag_command = '''INSERT OR IGNORE INTO tags (name) VALUES (?);'''
+        self.tag_ids_command = '''SELECT name, id FROM tags WHERE name IN (%s);'''
+        self.update_tags_command = '''INSERT OR IGNORE INTO post_tags \
+(post_id, tag_id) VALUES (?, ?);'''
+        self.tagged_command = '''SELECT post_id FROM post_tags WHERE tag_id = ?'''
+        self.all_posts_command = '''SELECT id FROM content'''
+        self.by_tags_command = '''SELECT id, md5, tags, present FROM content \
+WHERE id IN (%s) ORDER BY id;'''
         db = sqlite3.connect(self.db_filename)
         db.text_factory = lambda text: unicode(text, 'utf-8', 'ignore')
         cur = db.cursor()
+        for pragma in self.pragmas:
+            cur.execute(pragma)
         cur.execute(self.init_db_command)
+        cur.execute(self.init_md5_index_command)
+        cur.execute(self.init_cache_command)
+        cur.execute(self.init_tags_command)
+        cur.execute(self.init_post_tags_command)
         return db, cur
 
+    def upgrade_db(self):
+        '''Bring a db made by an older version up to the current schema'''
+        version, = self.cur.execute('PRAGMA user_version;').fetchone()
+        if version < 1:
+            self.index_tags()
+        if version < 2:
+            self.migrate_misc()
+        if version < 3:
+            self.add_present()
+        if version < self.schema_version:
+            self.cur.execute('PRAGMA user_version = %d;' % (self.schema_version,))
+            self.commit()
+
+    def index_tags(self, step=10000):
+        '''Build the tag index for posts stored before there was one'''
+        count, = self.cur.execute('SELECT COUNT(*) FROM content;').fetchone()
+        if not count:
+            return
+        print 'Indexing tags of %d %s...' % (count, case(count, 'post')),
+        start, last = time(), 0
+        while True:
+            rows = self.db.execute('''SELECT id, tags, misc FROM content \
+WHERE id > ? ORDER BY id LIMIT ?;''', (last, step)).fetchall()
+            if not rows: break
+            posts = []
+            for id, tags, misc in rows:
+                rating = (self.unpickle(misc) or {}).get('rating')
+                posts.append((id, tags, rating))
+            self.update_tags(posts)
+            last = rows[-1][0]
+        print self.end('done', start)
+
+    def migrate_misc(self, step=10000):
+        '''Move the post attributes out of the pickled misc into typed columns
+        and an encoded misc; pickles are never loaded after this'''
+        columns = [row[1] for row in self.cur.execute('PRAGMA table_info(content);')]
+        for name, kind in self.post_fields:
+            if name not in columns:
+                kind = 'INTEGER' if kind is int else 'TEXT'
+                self.cur.execute('ALTER TABLE content ADD COLUMN %s %s;' % \
+                    (name, kind))
+        count, = self.cur.execute('SELECT COUNT(*) FROM content;').fetchone()
+        if not count:
+            return
+        print 'Migrating %d %s to typed columns...' % (count, case(count, 'post')),
+        size, start = self.db_size(), time()
+        before = self.time_load('SELECT misc FROM content;',
+            lambda row: self.unpickle(row[0]))
+        last, broken = 0, 0
+        while True:
+            rows = self.db.execute('''SELECT id, md5, tags, misc FROM content \
+WHERE id > ? ORDER BY id LIMIT ?;''', (last, step)).fetchall()
+            if not rows: break
+            values = []
+            for id, hash, tags, misc in rows:
+                post = self.unpickle(misc)
+                if post is None:
+                    post, broken = {}, broken + 1
+                post.update(md5=hash, tags=tags)
+                row = self.pack_post(id, post)
+                values.append(row[3:] + row[:1])
+            self.cur.executemany('''UPDATE content SET width = ?, height = ?, \
+file_size = ?, score = ?, rating = ?, created_at = ?, file_url = ?, \
+parent_id = ?, misc = ? WHERE id = ?;''', values)
+            last = rows[-1][0]
+        self.commit()
+        self.cur.execute('VACUUM;')
+        print self.end('done', start)
+        after = self.time_load('SELECT %s FROM content;' % (self.post_columns,),
+            self.unpack_post)
+        values = (size / 2 ** 10, self.db_size() / 2 ** 10, before, after)
+        print 'Database size %d KiB -> %d KiB, loading every post %.2fs -> \
+%.2fs' % values
+        if broken:
+            print '%d %s had unreadable attributes' % \
+                (broken, case(broken, 'post'))
+
+    def add_present(self):
+        '''Add the flag that tells downloaded posts from mirrored ones (all
+        the posts stored before there were mirrors count as downloaded)'''
+        columns = [row[1] for row in self.cur.execute('PRAGMA table_info(content);')]
+        if 'present' not in columns:
+            self.cur.execute('''ALTER TABLE content ADD COLUMN \
+present INTEGER NOT NULL DEFAULT 1;''')
+        # Lets the md5 lookups of downloaded posts skip the table
+        self.cur.execute('DROP INDEX IF EXISTS content_md5;')
+        self.cur.execute('CREATE INDEX content_md5 ON content (md5, present);')
+
+    def unpickle(self, misc):
+        '''Load the attributes an older version pickled into misc, or None if
+        they can't be read'''
+        try:
+            post = pickle.loads(str(misc))
+        except Exception:
+            return None
+        return post if isinstance(post, dict) else None
+
+    def db_size(self):
+        '''Size of the db file and its write-ahead log'''
+        self.cur.execute('PRAGMA wal_checkpoint(TRUNCATE);')
+        return sum([os.path.getsize(name) for name in \
+            (self.db_filename, self.db_filename + '-wal') \
+            if os.path.exists(name)])
+
+    def time_load(self, command, decode):
+        '''Time reading and decoding every row a query returns'''
+        start = time()
+        for row in self.db.execute(command):
+            decode(row)
+        return time() - start
+
+    def pack_post(self, id, post):
+        '''Turn the attributes of a post into a content row'''
+        post = dict(post)
+        row = [id, post.pop('md5'), post.pop('tags')]
+        for name, kind in self.post_fields:
+            value = post.pop(name, None)
+            try:
+                row.append(kind(value) if value not in (None, '') else None)
+            except ValueError:
+                row.append(None)
+                post[name] = value
+        row.append(pack_misc(post))
+        return tuple(row)
+
+    def unpack_post(self, row):
+        '''Turn a content row back into the attributes of a post'''
+        post = unpack_misc(row[-1])
+        post.update(md5=row[1], tags=row[2])
+        for (name, kind), value in zip(self.post_fields, row[3:-1]):
+            if value is not None:
+                post[name] = value
+        return row[0], post
+
+    def load_posts(self, ids):
+        '''Get the stored attributes of posts by id'''
+        return dict(map(self.unpack_post,
+            self.select_in(self.posts_command, ids)))
+
+    def update_tags(self, posts):
+        '''Add (id, tags, rating) posts to the tag index; ratings are indexed
+        as rating:s, rating:q and rating:e tags'''
+        pairs = []
+        for id, tags, rating in posts:
+            if not isinstance(tags, unicode):
+                tags = unicode(tags, 'utf-8', 'ignore')
+            names = tags.split()
+            if rating:
+                names.append(self.rating_tag % (rating[0],))
+            pairs.extend([(id, name) for name in names])
+        tag_ids = self.intern_tags(set([name for id, name in pairs]))
+        self.cur.executemany(self.update_tags_command,
+            [(id, tag_ids[name]) for id, name in pairs])
+
+    def intern_tags(self, names):
+        '''Get the ids of tag names, adding the ones that are new'''
+        new = [name for name in names if name not in self.tag_ids]
+        if new:
+            self.cur.executemany(self.add_tag_command, [(name,) for name in new])
+            self.tag_ids.update(self.select_in(self.tag_ids_command, new))
+        return self.tag_ids
+
+    def query_db(self, terms):
+        '''Find local posts by tags; -tag excludes a tag and rating:safe (or
+        rating:s) limits the rating'''
+        include, exclude = [], []
+        for term in terms:
+            if not isinstance(term, unicode):
+                term = unicode(term, 'utf-8', 'ignore')
+            negated = term.startswith('-')
+            name = term[1:] if negated else term
+            if name.startswith('rating:'):
+                name = self.rating_tag % (name[7:8],)
+            (exclude if negated else include).append(name)
+        tag_ids = dict(self.select_in(self.tag_ids_command,
+            set(include + exclude)))
+        if [name for name in include if name not in tag_ids]:
+            return []
+        exclude = [name for name in exclude if name in tag_ids]
+        command = ' INTERSECT '.join([self.tagged_command] * len(include)) \
+            or self.all_posts_command
+        for name in exclude:
+            command += ' EXCEPT ' + self.tagged_command
+        values = [tag_ids[name] for name in include + exclude]
+        return self.db.execute(self.by_tags_command % (command,),
+            values).fetchall()
+
+    def list_local(self, args):
+        '''Print the local posts that match the tags'''
+        terms = [item.replace(' ', '_') for item in args]
+        if self['rating']:
+            terms.append(self.rating_tag % (self['rating'],))
+        print 'Querying the local database for %s...' % (' '.join(terms),)
+        start = time()
+        rows = self.query_db(terms)
+        for id, hash, tags, present in rows:
+            print '%07d %s%s' % (id, hash, '' if present else ' (mirrored)')
+        print self.end('%d %s found' % (len(rows), case(len(rows), 'post')),
+            start)
+
+    def in_chunks(self, command, values):
+        '''Split an "... IN (%s)" command for any number of values into
+        (command, values) chunks that stay under SQLite's limit on bound
+        variables'''
+        values = list(values)
+        for i in xrange(0, len(values), self.max_variables):
+            chunk = values[i:i+self.max_variables]
+            yield command % (', '.join('?' * len(chunk)),), chunk
+
+    def select_in(self, command, values):
+        '''Run an "... IN (%s)" query for any number of values'''
+        for command, chunk in self.in_chunks(command, values):
+            for row in self.db.execute(command, chunk).fetchall():
+                yield row
+
     def hash_in_filename(self, filename):
         '''Try to avoid hashing the file'''
         name, ext = os.path.splitext(os.path.basename(filename))
@@ -326,44 +1717,233 @@ WHERE md5 IN ("%s");'''
 
     def filter_hashes(self, hashes):
         '''Remove hashes that exist in the local database'''
-        values = '","'.join(hashes.values())
-        query = self.cur.execute(self.by_md5_command % values)
-        for hash in query:
-            hash, id = hash
-            for key, value in hashes.copy().iteritems():
-                if hash != value: continue
-                del hashes[key]
+        start, count = xtime(), len(hashes)
+        query = self.select_in(self.present_md5_command,
+            set(hashes.itervalues()))
+        known = set(hash for hash, id in query)
+        for key in [key for key, value in hashes.iteritems() if value in known]:
+            del hashes[key]
+        self.metrics.record('filter', xtime() - start, items=count)
         return hashes
 
     def get_hashes(self, names, source, filter=True):
         '''Get hashes for files in a path'''
         print 'Getting hashes for %d %s in %s...' % \
             (len(names), case(len(names), 'file'), source),
-        results, start = {}, time()
-        for item in names:
-            hash = self.hash_in_filename(item) \
-                or md5(open(item, 'rb').read()).hexdigest()
-            results[item] = hash
+        start = time()
+        results, cached, unhashed, stats = self.split_hashes(names)
+        begun = xtime()
+        hashed = self.hash_files(unhashed)
+        self.record_hashes(hashed, stats, begun)
+        self.cache_hashes(hashed, stats)
+        results.update(cached)
+        results.update(hashed)
         if filter:
             results = self.filter_hashes(results)
-        print self.end('done', start)
+        print self.end('done', start),
+        print '(%d cached, %d hashed)' % (len(cached), len(hashed))
         return results
 
+    def split_hashes(self, names):
+        '''Split files into the ones with a hash in their name and the ones
+        with a hash in the cache (as dicts of filename: hash), and a list of
+        the ones that need hashing; the cache's stats of those come last'''
+        named, unnamed = {}, []
+        for item in names:
+            hash = self.hash_in_filename(item)
+            if hash:
+                named[item] = hash
+            else:
+                unnamed.append(item)
+        cached, stats = self.cached_hashes(unnamed)
+        unhashed = [item for item in unnamed if item not in cached]
+        return named, cached, unhashed, stats
+
+    def cached_hashes(self, names):
+        '''Look files up in the hash cache; an entry only counts if the file
+        still has the same size, mtime and inode'''
+        results, stats = {}, {}
+        for item in names:
+            stat = os.stat(item)
+            stats[item] = key = (stat.st_size, stat.st_mtime, stat.st_ino)
+            row = self.cur.execute(self.by_path_command,
+                (os.path.abspath(item),)).fetchone()
+            if row and tuple(row[:3]) == key:
+                results[item] = row[3]
+        self.cache_hits += len(results)
+        self.cache_misses += len(names) - len(results)
+        return results, stats
+
+    def cache_hashes(self, hashes, stats):
+        '''Remember freshly computed hashes along with the file stats'''
+        rows = [(os.path.abspath(item),) + stats[item] + (hash,) \
+            for item, hash in hashes.iteritems()]
+        self.cur.executemany(self.update_cache_command, rows)
+        self.commit()
+
+    def prune_hashes(self):
+        '''Drop cached hashes of files that are gone or have changed'''
+        print 'Pruning the hash cache...',
+        start, stale = time(), []
+        rows = self.cur.execute(self.all_cached_command).fetchall()
+        for path, size, mtime, inode in rows:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                stale.append((path,))
+                continue
+            if (stat.st_size, stat.st_mtime, stat.st_ino) != (size, mtime, inode):
+                stale.append((path,))
+        self.cur.executemany(self.prune_cache_command, stale)
+        self.commit()
+        print self.end('done', start)
+        print '%d of %d %s pruned' % (len(stale), len(rows),
+            cases(len(rows), 'entry', 'entries'))
+
+    def hash_files(self, names):
+        '''Hash files on a pool of processes (one per core by default)'''
+        return dict(self.iter_hashes(names))
+
+    def iter_hashes(self, names):
+        '''Hash files on a pool of processes, yielding (filename, hash) as
+        they're finished'''
+        jobs = min(self['jobs'], len(names))
+        if jobs < 2:
+            for item in names:
+                yield hash_file(item)
+            return
+        pool, finished = Pool(jobs), False
+        try:
+            results = pool.imap_unordered(hash_file, names,
+                max(1, min(64, len(names) // (jobs * 8))))
+            for i in xrange(len(names)):
+                # A timeout keeps the wait interruptible with ctrl-c
+                yield results.next(2 ** 31)
+            finished = True
+        finally:
+            if finished:
+                pool.close()
+            else:
+                pool.terminate()
+            pool.join()
+
+    def stream_hashes(self, names, step=1000):
+        '''Yield dicts of filename: hash, first for the files that don't need
+        hashing and then step freshly hashed (and cached) files at a time'''
+        results, cached, unhashed, stats = self.split_hashes(names)
+        results.update(cached)
+        yield results
+        hashed, begun = {}, xtime()
+        for item, hash in self.iter_hashes(unhashed):
+            hashed[item] = hash
+            if len(hashed) == step:
+                self.record_hashes(hashed, stats, begun)
+                self.cache_hashes(hashed, stats)
+                yield hashed
+                hashed, begun = {}, xtime()
+        if hashed:
+            self.record_hashes(hashed, stats, begun)
+            self.cache_hashes(hashed, stats)
+            yield hashed
+
+    def record_hashes(self, hashes, stats, start):
+        if hashes:
+            self.metrics.record('hash', xtime() - start,
+                sum(stats[item][0] for item in hashes), len(hashes))
+
+    def find_posts(self, hashes):
+        '''Look posts up by their md5 (only get_data's retries are reported,
+        on stderr, so it can run on threads)'''
+        return self.get_data(self.api_url + self.md5_path % ','.join(hashes),
+            'post', 'id')
+
     def catalogue_content(self, pathname):
-        '''Add files to the local database'''
+        '''Add files to the local database; hashes are looked up on a few
+        threads while the rest of the files are still being hashed, and the
+        ones the api doesn't know are checkpointed, so an interrupted run can
+        carry on where it stopped'''
         print 'Starting to catalogue %s...' % (pathname,)
+        key, start = os.path.abspath(pathname), time()
+        checkpoints = self.settings.get('catalogue', {})
+        missing = checkpoints.get(key, set())
         filenames = self.get_filenames(pathname)
-        hashes = self.get_hashes(filenames, pathname)
-        message = '%d of %d files already in local database'
-        print message % (len(filenames)-len(hashes), len(filenames))
-        count, step = 0, 100
-        for i in xrange(0, len(hashes), step):
-            data = self.get_content_data(hashes=hashes.values()[i:i+step])
-            count += len(data)
-            if self['simulate']: continue
-            self.update_db(data)
-            self.db.commit()
-        print '%d %s added to database' % (count, cases(count, 'entry', 'entries'))
+        workers = max(self['threads'], 2)
+        lookups = WorkerPool(self.find_posts, workers)
+        counts = dict.fromkeys(('hashed', 'known', 'found', 'failed'), 0)
+        seen, batch, step, unsaved = set(missing), [], 100, [0]
+        skipped = len(missing)
+
+        def save():
+            if self['simulate']: return
+            self.commit()
+            checkpoints[key] = missing
+            self.save_settings(catalogue=checkpoints)
+            unsaved[0] = 0
+
+        def handle(result):
+            hashes, data, error = result
+            if isinstance(error, IOError):
+                self.error('%s (%d hashes will be looked up again next time)' \
+                    % (error, len(hashes)))
+                counts['failed'] += len(hashes)
+                return
+            elif error:
+                raise error
+            counts['found'] += len(data)
+            missing.update(set(hashes) - \
+                set(value['md5'] for value in data.itervalues()))
+            if not self['simulate']:
+                self.update_db(data)
+            unsaved[0] += len(hashes)
+            if unsaved[0] >= step * 10:
+                save()
+            values = (counts['hashed'], len(filenames), counts['known'],
+                counts['found'])
+            print '\r%d of %d files checked, %d already in the local database, \
+%d found  ' % values,
+
+        try:
+            for hashes in self.stream_hashes(filenames):
+                counts['hashed'] += len(hashes)
+                count = len(hashes)
+                fresh = set(self.filter_hashes(hashes).itervalues()) - seen
+                counts['known'] += count - len(hashes)
+                seen.update(fresh)
+                # Mirrored posts need no api request
+                mirrored = dict(self.select_in(self.by_md5_command, fresh))
+                if mirrored and not self['simulate']:
+                    self.mark_present(mirrored.values())
+                counts['found'] += len(mirrored)
+                fresh.difference_update(mirrored)
+                batch.extend(fresh)
+                while len(batch) >= step:
+                    lookups.put(batch[:step])
+                    batch = batch[step:]
+                    if lookups.pending >= workers * 2:
+                        handle(lookups.get())
+                for result in lookups.ready():
+                    handle(result)
+            if batch:
+                lookups.put(batch)
+            while lookups.pending:
+                handle(lookups.get())
+        except KeyboardInterrupt:
+            save()
+            print '\nCatalogue cancelled'
+            self.exit()
+        finally:
+            lookups.close()
+        save()
+        if not counts['failed'] and not self['simulate']:
+            del checkpoints[key]
+            self.save_settings(catalogue=checkpoints)
+        print
+        if skipped:
+            print '%d %s skipped (not found by the api last time)' % (skipped,
+                cases(skipped, 'hash', 'hashes'))
+        count = counts['found']
+        print self.end('%d %s added to database' % (count,
+            cases(count, 'entry', 'entries')), start)
 
     def split_path(self, pathname):
         '''Split the path in a tuple of three'''
@@ -375,29 +1955,79 @@ WHERE md5 IN ("%s");'''
         '''Rename files to id_hash'''
         print 'Fixing filenames in %s...' % (pathname,)
         filenames = self.get_filenames(pathname)
-        start, count = time(), 0
+        count = 0
         hashes = self.get_hashes(filenames, pathname, filter=False)
-        values = '","'.join(hashes.values())
-        query = self.cur.execute(self.by_md5_command % values)
-        query = dict(query.fetchall())
-        for filename, hash in hashes.iteritems():
-            if hash not in query.keys():
+        query = self.select_in(self.by_md5_command, set(hashes.itervalues()))
+        for filename, newname in self.plan_renames(hashes, dict(query)):
+            if not newname:
+                os.remove(filename)
+                del hashes[filename]
                 continue
-            folder, oldname, ext = self.split_path(filename)
-            # Figure out the new name (id is padded with zeroes)
-            newname = '%07d_%s%s' % (query[hash], hash, ext)
-            newname = os.path.join(folder, newname)
-            if filename == newname:
+            try: os.rename(filename, newname)
+            except OSError, e:
+                print e
                 continue
-            if os.path.exists(newname):
-                os.remove(filename)
-            else:
-                try: os.rename(filename, newname)
-                except WindowsError, e:
-                    print e
-                    count -= 1
-                count += 1
+            hashes[newname] = hashes.pop(filename)
+            count += 1
         print '%d %s fixed' % (count, case(count, 'filename'))
+        if self['store'] and not self['simulate']:
+            self.store_files(hashes)
+
+    def plan_renames(self, hashes, ids):
+        '''Work out how to give files (a dict of filename: hash) their id_hash
+        names, ids being a dict of hash: id; returns (filename, newname) pairs,
+        where a newname of None means the file is a duplicate to remove'''
+        names, plan = set(hashes), []
+        for hash, filenames in index_hashes(hashes).iteritems():
+            if hash not in ids:
+                continue
+            # Sorted, so which duplicate survives doesn't depend on dict order
+            for filename in sorted(filenames):
+                folder, oldname, ext = self.split_path(filename)
+                # Figure out the new name (id is padded with zeroes)
+                newname = '%07d_%s%s' % (ids[hash], hash, ext)
+                newname = os.path.join(folder, newname)
+                if filename == newname:
+                    continue
+                if newname in names:
+                    plan.append((filename, None))
+                else:
+                    names.add(newname)
+                    plan.append((filename, newname))
+        return plan
+
+    def store_files(self, hashes):
+        '''Move files (a dict of filename: hash) into the store and leave links
+        in their place; the ones whose content is stored already are replaced
+        with links to it'''
+        start, moved, merged = time(), 0, 0
+        samefile = getattr(os.path, 'samefile', lambda a, b: False)
+        for filename, hash in hashes.iteritems():
+            blob = self.blob_path(hash, os.path.splitext(filename)[1])
+            try:
+                if os.path.exists(blob):
+                    if samefile(blob, filename):
+                        continue
+                    # Link next to the file first, so it's never missing
+                    temporary = filename + '.link'
+                    if not link_file(blob, temporary):
+                        continue
+                    os.rename(temporary, filename)
+                    merged += 1
+                    continue
+                folder = os.path.dirname(blob)
+                if not os.path.isdir(folder):
+                    os.makedirs(folder)
+                move_file(filename, blob)
+                if not link_file(blob, filename):
+                    move_file(blob, filename)
+                    continue
+                moved += 1
+            except (IOError, OSError), e:
+                self.error('%s (%s)' % (e, filename))
+        message = '%d %s moved to the store, %d %s replaced with links'
+        print self.end(message % (moved, case(moved, 'file'), merged,
+            case(merged, 'duplicate')), start)
 
     def expand_paths(self, source):
         '''Does exactly what the name says'''
@@ -408,77 +2038,307 @@ WHERE md5 IN ("%s");'''
 
     def get_filenames(self, pathname):
         '''Again, does just what the name says'''
-        names = glob(os.path.join(pathname, '*'))
-        return filter(os.path.isfile, names)
+        if not scandir:
+            names = glob(os.path.join(pathname, '*'))
+            names = filter(os.path.isfile, names)
+        else:
+            # Skip dotfiles like glob does; is_file() mostly needs no stat
+            names = [entry.path for entry in scandir(pathname) \
+                if not entry.name.startswith('.') and entry.is_file()]
+        return [name for name in names if not name.endswith(self.leftovers)]
 
     def update_db(self, data):
         '''Write data to the transaction (has to be committed to the db explicitly)'''
-        for key, value in data.iteritems():
-            #~ value['author'] = value['author'].encode('utf-8')
-            values = (key, value.pop('md5'), value.pop('tags'), pickle.dumps(value))
-            try:
-                self.cur.execute(self.update_db_command % values)
-            except sqlite3.OperationalError, e:
-                print e
+        rows = [self.pack_post(key, value) for key, value in data.iteritems()]
+        try:
+            self.cur.executemany(self.update_db_command, rows)
+            self.mark_present(data.keys())
+            self.update_tags([(key, value['tags'], value.get('rating')) \
+                for key, value in data.iteritems()])
+        except sqlite3.OperationalError, e:
+            print e
 
+    def mark_present(self, ids):
+        '''Flag mirrored posts as downloaded'''
+        for command, chunk in self.in_chunks(self.mark_present_command, ids):
+            self.cur.execute(command, chunk)
+
+    def mirror_posts(self, data):
+        '''Store the metadata of posts that haven't been downloaded'''
+        rows = [self.pack_post(key, value) for key, value in data.iteritems()]
+        self.cur.executemany(self.mirror_command, rows)
+        self.update_tags([(key, value['tags'], value.get('rating')) \
+            for key, value in data.iteritems()])
 
-class Downloader(object):
-    '''Shows a progress bar for downloads. this is actually useful outside the
-    scope of danbooru.py'''
 
-    before = .0
-    history = []
-    cycles = 0
-    average = lambda self: sum(self.history) / (len(self.history) or 1)
+class Downloader(object):
+    '''Downloads files one at a time with a progress bar. this is actually
+    useful outside the scope of danbooru.py'''
 
-    def __init__(self, width=55):
-        self.width = width
+    def __init__(self, width=55, http=None):
+        self.http = http or HTTPPool()
+        self.progress = Progress(bar=width)
         self.kibi = lambda bits: bits / 2 ** 10
-        self.proc = lambda a, b: a / (b * 0.01)
 
-    def retrieve(self, url, destination, callback=None):
-        self.size = 0
-        xtime()
-        try: urllib.urlretrieve(url, destination, self.progress)
+    def retrieve(self, url, destination, callback=None, size=None, hash=None):
+        transfer = self.progress.start(destination, size)
+        try:
+            try: self.http.retrieve(url, destination, transfer.update,
+                size=size, hash=hash)
+            finally:
+                self.progress.finish(transfer)
+                self.progress.close()
         except KeyboardInterrupt:
-            print '\nDownload cancelled'
-            for i in range(5):
-                try:
-                    os.remove(destination)
-                    break
-                except:
-                    sleep(.1)
-            else: raise
+            # The .part file stays behind for the next run to resume
+            print 'Download cancelled'
             if callback: callback()
             exit()
-        print
-        return self.size
-
-    def progress(self, blocks, blocksize, filesize):
-        self.cycles += 1
-        bits = min(blocks*blocksize, filesize)
-        done = self.proc(bits, filesize) if bits != filesize else 100
-        bar = self.bar(done)
-        if not self.cycles % 3 and bits != filesize:
-            now = xtime()
-            elapsed = now-self.before
-            if elapsed:
-                speed = self.kibi(blocksize * 3 / elapsed)
-                self.history.append(speed)
-                self.history = self.history[-4:]
-            self.before = now
-        average = round(sum(self.history[-4:]) / 4, 1)
-        self.size = self.kibi(bits)
-        print '\r[%s] %s KiB/s  ' % (bar, str(average)),
-
-    def bar(self, done):
-        span = self.width * done * 0.01
+        return self.kibi(transfer.bits)
+
+
+class Transfer(object):
+    '''The state of one download; the transfer loop only sets numbers on it,
+    the rates and the drawing are up to Progress'''
+
+    def __init__(self, name, size=None):
+        self.name = name
+        self.size = int(size or -1)
+        self.bits = 0
+        self.rate = .0
+        # What a resumed transfer started from, and bits at the last refresh
+        self.offset = None
+        self.seen = None
+
+    def update(self, blocks, blocksize, filesize):
+        '''A retrieve() reporthook'''
+        bits = blocks * blocksize
+        self.bits = min(bits, filesize) if filesize > 0 else bits
+        self.size = filesize
+        if self.offset is None:
+            self.offset = self.bits
+
+    def moved(self):
+        '''Bits transferred since the last refresh'''
+        seen = self.seen if self.seen is not None else self.offset or 0
+        # Going back to 0 (a retry) doesn't count as negative progress
+        return max(self.bits - seen, 0)
+
+
+class Progress(object):
+    '''Draws the progress of any number of transfers on one line, from a
+    thread of its own that refreshes it at a fixed rate: as a bar of the given
+    width for a single transfer, or else as the totals and the percentage and
+    rate of each transfer. Nothing is drawn when the output isn't a terminal'''
+
+    refresh = .25
+    # How much of a smoothed rate the latest refresh makes up
+    smoothing = .3
+    columns = 79
+
+    def __init__(self, bar=0, output=None):
+        self.bar = bar
+        self.output = output
+        self.lock = threading.Lock()
+        self.active = []
+        self.last = None
+        self.bits = 0
+        self.done = 0
+        self.rate = .0
+        # Bits of the transfers finished since the last refresh
+        self.unseen = 0
+        self.drawn = 0
+        self.stamp = xtime()
+        self.renderer = None
+        self.kibi = lambda bits: bits / 2. ** 10
+
+    def start(self, name, size=None):
+        '''Register a transfer; its update() is the reporthook to use'''
+        transfer = Transfer(name, size)
+        with self.lock:
+            self.active.append(transfer)
+        output = self.output or sys.stdout
+        if not self.renderer and getattr(output, 'isatty', lambda: False)():
+            self.renderer = threading.Thread(target=self.render)
+            self.renderer.setDaemon(True)
+            self.renderer.start()
+        return transfer
+
+    def finish(self, transfer):
+        '''Move a transfer from the active ones to the totals'''
+        with self.lock:
+            self.active.remove(transfer)
+            self.unseen += transfer.moved()
+            self.bits += transfer.bits
+            self.done += 1
+            self.last = transfer
+
+    def close(self):
+        '''Draw the line one last time and end it, if it was drawn'''
+        with self.lock:
+            if not self.drawn: return
+            self.draw()
+            self.write('\n')
+            self.drawn = 0
+
+    def render(self):
+        while True:
+            sleep(self.refresh)
+            with self.lock:
+                if self.active:
+                    self.draw()
+
+    def draw(self):
+        '''Update the rates and redraw the line (the lock has to be held)'''
+        now = xtime()
+        elapsed, self.stamp = now - self.stamp, now
+        moved, self.unseen = self.unseen, 0
+        for transfer in self.active:
+            bits = transfer.moved()
+            moved += bits
+            # A transfer's first refresh covers less than elapsed
+            if transfer.seen is not None and elapsed:
+                transfer.rate += self.smoothing * (bits / elapsed - transfer.rate)
+            transfer.seen = transfer.bits
+        if elapsed:
+            self.rate += self.smoothing * (moved / elapsed - self.rate)
+        if self.bar:
+            transfer = (self.active or [self.last])[-1]
+            done = 100. * transfer.bits / transfer.size \
+                if transfer.size > 0 else 0
+            line = '[%s] %.1f KiB/s' % (self.draw_bar(done),
+                self.kibi(self.rate))
+        else:
+            bits = self.bits + sum(transfer.bits for transfer in self.active)
+            values = (self.done, len(self.active), self.kibi(bits),
+                self.kibi(self.rate))
+            line = '%d done, %d active, %d KiB  %.1f KiB/s' % values
+            for transfer in self.active:
+                done = 100 * transfer.bits // transfer.size \
+                    if transfer.size > 0 else 0
+                line += ' | %d%% %.0f' % (done, self.kibi(transfer.rate))
+        line = line[:self.columns]
+        self.write('\r' + line.ljust(self.drawn))
+        self.drawn = len(line)
+
+    def draw_bar(self, done):
+        span = self.bar * done * 0.01
         offset = len(str(int(done))) - .99
-        result = ('%d%%' % (done,)).center(self.width)
+        result = ('%d%%' % (done,)).center(self.bar)
         return result.replace(' ', '-', int(span - offset))
 
+    def write(self, text):
+        output = self.output or sys.stdout
+        output.write(text)
+        output.flush()
+
+
+class WorkerPool(object):
+    '''Runs a function on worker threads; the thread that feeds it collects
+    the results, so things like database writes stay on one thread'''
+
+    refresh = .5
+
+    def __init__(self, function, workers=4, profiler=None):
+        self.function = function
+        self.profiler = profiler
+        self.queue = Queue()
+        self.results = Queue()
+        self.pending = 0
+        self.workers = workers
+        for i in xrange(workers):
+            worker = threading.Thread(target=self.work)
+            worker.setDaemon(True)
+            worker.start()
+
+    def put(self, item):
+        self.queue.put(item)
+        self.pending += 1
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            try:
+                if self.profiler:
+                    result = self.profiler.runcall(self.function, item)
+                else:
+                    result = self.function(item)
+                self.results.put((item, result, None))
+            except Exception, e:
+                # Anything that escapes would kill the worker and hang get()
+                self.results.put((item, None, e))
+
+    def get(self):
+        '''Wait for the next (item, result, error) without blocking
+        KeyboardInterrupt'''
+        result = poll(self.results, self.refresh)
+        self.pending -= 1
+        return result
+
+    def ready(self):
+        '''The results that are in without waiting'''
+        results = []
+        while True:
+            try:
+                results.append(self.results.get(False))
+            except Empty:
+                break
+        self.pending -= len(results)
+        return results
+
+    def close(self):
+        for i in xrange(self.workers):
+            self.queue.put(None)
+
+
+class DownloadPool(WorkerPool):
+    '''Runs downloads on a fixed number of worker threads; how many of them
+    may talk to the same host at once is up to the host's Throttle'''
+
+    def __init__(self, workers=4, http=None, profiler=None):
+        self.http = http or HTTPPool()
+        self.progress = Progress()
+        WorkerPool.__init__(self, self.transfer, workers, profiler)
 
-def parse_options():
+    def slot(self, url):
+        '''Get the Throttle that limits the transfers to the url's host'''
+        return self.http.throttle(urlsplit(url)[1])
+
+    def put(self, key, url, destination, size=None, hash=None):
+        WorkerPool.put(self, (key, url, destination, size, hash))
+
+    def transfer(self, item):
+        key, url, destination, size, hash = item
+        slot = self.slot(url)
+        with slot:
+            transfer = self.progress.start(destination, size)
+            try:
+                # Backing off gives the slot to the host's other transfers
+                self.http.retrieve(url, destination, transfer.update,
+                    size=size, hash=hash, pause=slot.rest)
+            finally:
+                self.progress.finish(transfer)
+
+    def wait(self, count, callback=None):
+        '''Block until count transfers are finished and return their keys,
+        urls and errors'''
+        results = []
+        try:
+            while len(results) < count:
+                item, result, error = self.get()
+                results.append((item[0], item[1], error))
+        except KeyboardInterrupt:
+            # Unfinished .part files stay behind for the next run to resume
+            self.progress.close()
+            print 'Download cancelled'
+            if callback: callback()
+            exit()
+        self.progress.close()
+        return results
+
+
+def parse_options(argv=None):
     '''Parse arguments passed to the script'''
     help = { 'limit': 'set how many posts (not files) to get from the api \
 [default: %default]',
@@ -499,9 +2359,50 @@ in the local database',
         'set_default': 'set a default server',
         'rating': 'convenience shortcut to the rating: tag',
         'simulate': 'don\'t download files or add posts to the database',
+        'threads': 'how many files to download at once [default: %default]',
+        'per_host': 'how many of those may come from the same host (fewer \
+while it answers with 429 or 5xx errors) [default: %default]',
+        'timeout': 'seconds to wait for a server before giving up \
+[default: %default]',
+        'jobs': 'how many processes to hash files with [default: %default]',
+        'prune_cache': 'remove hashes of missing or changed files from the \
+hash cache',
+        'local': 'list the posts in the local database that match the tags \
+(-tag excludes a tag, put -- before it) instead of downloading',
+        'rate': 'how many requests per second to send to a host, 0 for no \
+limit [default: %default]',
+        'retries': 'how many times to retry a failed api request or download \
+[default: %default]',
+        'sync': 'only get posts newer than the last synced one for these \
+tags (the first sync starts after the highest id in the folder)',
+        'batch': 'run the queries in a file, one per line as "tags" or \
+"folder: tags"; a post that matches several is only downloaded once',
+        'prefetch': 'how many api pages to fetch ahead of the downloads \
+[default: %default]',
+        'metrics_file': 'save how long each stage (api, parse, filter, \
+download, network, write, hash, commit) took and how much went through it \
+to a file at exit: appended as JSON lines, or as a Prometheus text file if \
+FILE ends in .prom',
+        'profile_file': 'save cProfile stats of the downloads (on every \
+thread that works on them) to a file at exit',
+        'fsync': 'fsync downloads after every NUM MiB written and before \
+they\'re renamed into place, 0 for never [default: %default]',
+        'mirror': 'copy the metadata of the posts that match the tags (every \
+post without tags) into the local database instead of downloading, picking \
+up after the last mirrored post',
+        'offline': 'take the posts that match the tags from the local \
+database (see --mirror) instead of asking the api; with -e, list them',
+        'api_url': 'the api to use [default: %s]' % (Robot.api_url,),
+        'file_server': 'where to download the files from [default: %s]' % \
+            (Robot.file_server,),
+        'store': 'keep every file once in a store folder, sorted by hash, and \
+hardlink (or symlink) it into the tag folders; -x moves the files it fixes \
+into the store',
     }
     usage = '%prog [-l NUM] [-o NUM] [-s NUM] [-r safe|questionable|explicit] \
-[-f PATH] [-i] [-n] [-c PATH] [-x PATH] [-u] [-L] [-d] <tags>'
+[-f PATH] [-i] [-n] [-c PATH] [-x PATH] [-u] [-L] [-d] [-t NUM] [-S] [-Q] \
+[-b FILE] [-M] [-O] [--fsync NUM] [--store PATH] \
+[--metrics FILE] [--profile FILE] <tags>'
     from optparse import OptionParser
     parser = OptionParser(usage=usage, version='%s.%s' % (__version__, __build__),
         description='A tool for retrieving content from danbooru.donmai.us')
@@ -531,15 +2432,67 @@ in the local database',
         #~ help=help['set_default'], metavar='ID', default=None, type='int')
     parser.add_option('-e', '--simulate', dest='simulate', \
         help=help['simulate'], action='store_true', default=False)
-    options, args = parser.parse_args()
+    parser.add_option('-t', '--threads', dest='threads', help=help['threads'], \
+        metavar='NUM', default=1, type='int')
+    parser.add_option('--per-host', dest='per_host', help=help['per_host'], \
+        metavar='NUM', default=2, type='int')
+    parser.add_option('--prefetch', dest='prefetch', help=help['prefetch'], \
+        metavar='NUM', default=1, type='int')
+    parser.add_option('--timeout', dest='timeout', help=help['timeout'], \
+        metavar='SECS', default=30, type='float')
+    parser.add_option('-j', '--jobs', dest='jobs', help=help['jobs'], \
+        metavar='NUM', default=cpu_count(), type='int')
+    parser.add_option('--prune-cache', dest='prune_cache', \
+        help=help['prune_cache'], action='store_true', default=False)
+    parser.add_option('--rate', dest='rate', help=help['rate'], \
+        metavar='NUM', default=0, type='float')
+    parser.add_option('--retries', dest='retries', help=help['retries'], \
+        metavar='NUM', default=5, type='int')
+    parser.add_option('-S', '--sync', dest='sync', help=help['sync'], \
+        action='store_true', default=False)
+    parser.add_option('-b', '--batch', dest='batch', help=help['batch'], \
+        metavar='FILE', default=None)
+    parser.add_option('--store', dest='store', help=help['store'], \
+        metavar='PATH', default=None)
+    parser.add_option('--fsync', dest='fsync', help=help['fsync'], \
+        metavar='NUM', default=0, type='float')
+    parser.add_option('-M', '--mirror', dest='mirror', help=help['mirror'], \
+        action='store_true', default=False)
+    parser.add_option('-O', '--offline', dest='offline', \
+        help=help['offline'], action='store_true', default=False)
+    parser.add_option('--api', dest='api_url', help=help['api_url'], \
+        metavar='URL', default=None)
+    parser.add_option('--file-server', dest='file_server', \
+        help=help['file_server'], metavar='URL', default=None)
+    parser.add_option('--metrics', dest='metrics_file', \
+        help=help['metrics_file'], metavar='FILE', default=None)
+    parser.add_option('--profile', dest='profile_file', \
+        help=help['profile_file'], metavar='FILE', default=None)
+    parser.add_option('-Q', '--local', dest='local', help=help['local'], \
+        action='store_true', default=False)
+    options, args = parser.parse_args(argv)
     return options, args, parser
 
 
+def make_robot(options, args):
+    '''Set up a Robot with the options returned by optparse'''
+    return Robot(args, options.limit, options.offset, rating=options.rating,
+        refresh=False, nodb=options.nodb, simulate=options.simulate,
+        threads=options.threads, per_host=options.per_host,
+        prefetch=options.prefetch, timeout=options.timeout,
+        jobs=options.jobs, rate=options.rate, retries=options.retries,
+        sync=options.sync, store=options.store,
+        metrics_file=options.metrics_file, profile_file=options.profile_file,
+        api_url=options.api_url, file_server=options.file_server,
+        offline=options.offline, fsync=options.fsync)
+
+
 def main():
     '''Decide what to do based on the options returned by optparse'''
     options, args, parser = parse_options()
-    robot = Robot(args, options.limit, options.offset, rating=options.rating,
-        refresh=False, nodb=options.nodb, simulate=options.simulate)
+    robot = make_robot(options, args)
+    # Runs cut short by an error or ^C keep their metrics and profile too
+    atexit.register(robot.write_stats)
     if options.rating:
         values = ('safe', 'explicit', 'questionable')
         if options.rating not in values:
@@ -548,6 +2501,8 @@ def main():
             robot.rating = options.rating
     #~ if options.refresh:
         #~ print 'Using No Last ID mode...'
+    if options.mirror and options.offline:
+        parser.error('-M needs the api, so it can\'t be used with -O')
     if options.folder:
         robot.folder = options.folder
     if options.catalogue:
@@ -556,6 +2511,8 @@ def main():
     if options.fixnames:
         for name in robot.expand_paths(options.fixnames):
             robot.fix_filenames(name)
+    if options.prune_cache:
+        robot.prune_hashes()
     #~ if options.update:
         #~ robot.update_servers()
     #~ if options.set_default:
@@ -579,7 +2536,14 @@ def main():
             #~ robot.use_server(robot.settings['default'])
         #~ print 'Using server %d (%s)' % \
             #~ (robot.server, robot.servers[robot.server]['host'])
-    robot.retrieve_content()
+    if options.local:
+        robot.list_local(args)
+    elif options.mirror:
+        robot.mirror_content()
+    elif options.batch:
+        robot.profile(robot.run_batch, options.batch)
+    elif robot.tags:
+        robot.profile(robot.retrieve_content)
     robot.exit()
 
 
@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+
+'''
+test_danbooru.py
+================
+Tests for danbooru.py; run them with "python -m unittest test_danbooru".
+'''
+
+import os
+import errno
+import shutil
+import sqlite3
+import pickle
+import pstats
+import unittest
+import threading
+
+from StringIO import StringIO
+from tempfile import mkdtemp
+from time import sleep
+from urlparse import urlsplit
+
+import danbooru
+from benchmark import MockServer, make_robot, mock_robot, quietly
+
+
+def hang_up(http):
+    '''Close the connections an HTTPPool keeps alive'''
+    for connections in http.idle.values():
+        for connection in connections:
+            connection.close()
+
+
+class RobotTestCase(unittest.TestCase):
+    '''Gives every test a folder of its own, and closes the Robots made with
+    self.robot() when it's done'''
+
+    def setUp(self):
+        self.folder = mkdtemp()
+        self.robots = []
+
+    def tearDown(self):
+        for robot in self.robots:
+            hang_up(robot.http)
+            robot.db.close()
+            robot.settings.close()
+        shutil.rmtree(self.folder)
+
+    def robot(self, *argv):
+        robot = quietly(make_robot, self.folder, *argv)
+        self.robots.append(robot)
+        return robot
+
+
+class ConstructorTest(RobotTestCase):
+
+    def test_baseline_options(self):
+        danbooru.Robot.settings_filename = os.path.join(self.folder,
+            'settings')
+        danbooru.Robot.db_filename = os.path.join(self.folder, 'db')
+        robot = quietly(lambda: danbooru.Robot(['cat_ears'], 100, 0,
+            rating=None, refresh=False, nodb=False, simulate=False))
+        self.robots.append(robot)
+        self.assertEqual(robot.pool, None)
+        self.assertEqual(robot['retries'], 5)
+        self.assertEqual(robot.api_url, danbooru.Robot.api_url)
+
+
+class MigrationTest(RobotTestCase):
+
+    def legacy_db(self, rows):
+        '''Make a db the way the first versions did: pickled misc and no
+        user_version'''
+        db = sqlite3.connect(os.path.join(self.folder, 'db'))
+        db.execute('''CREATE TABLE content (id INTEGER PRIMARY KEY, md5 TEXT, \
+tags TEXT, misc BLOB);''')
+        db.executemany('INSERT INTO content VALUES (?, ?, ?, ?);', rows)
+        db.commit()
+        db.close()
+
+    def test_corrupt_pickle(self):
+        misc = pickle.dumps({'width': '800', 'rating': 's', 'author': 'a'})
+        self.legacy_db([(1, 'a' * 32, 'cat_ears', sqlite3.Binary(misc)),
+            (2, 'b' * 32, 'negima', sqlite3.Binary('not a pickle'))])
+        robot = self.robot()
+        version, = robot.cur.execute('PRAGMA user_version;').fetchone()
+        self.assertEqual(version, robot.schema_version)
+        posts = robot.load_posts([1, 2])
+        self.assertEqual(posts[1]['width'], 800)
+        self.assertEqual(posts[1]['author'], 'a')
+        self.assertEqual(posts[2], {'md5': 'b' * 32, 'tags': 'negima'})
+        self.assertEqual([row[0] for row in robot.query_db(['rating:s'])], [1])
+
+
+class ChunkTest(RobotTestCase):
+
+    def test_mark_present(self):
+        robot = self.robot()
+        robot.max_variables = 3
+        posts = dict((id, {'md5': '%032x' % (id,), 'tags': 'negima'}) \
+            for id in xrange(1, 11))
+        robot.mirror_posts(posts)
+        robot.mark_present(range(1, 8))
+        self.assertEqual([len(chunk) for command, chunk in
+            robot.in_chunks(robot.mark_present_command, range(1, 8))],
+            [3, 3, 1])
+        present = robot.select_in('SELECT id FROM content WHERE present = 1 \
+AND id IN (%s);', posts)
+        self.assertEqual(sorted(row[0] for row in present), range(1, 8))
+
+
+class MaxIdTest(RobotTestCase):
+
+    def touch(self, folder, id):
+        open(os.path.join(folder, '%d_%s.jpg' % (id, 'a' * 32)), 'w').close()
+
+    def test_same_mtime(self):
+        folder = os.path.join(self.folder, 'posts')
+        os.mkdir(folder)
+        self.touch(folder, 5)
+        os.utime(folder, (1000000000, 1000000000))
+        robot = self.robot()
+        self.assertEqual(robot.get_max_id(folder), 5)
+        # A file added within the same second, on a filesystem that keeps
+        # whole seconds
+        self.touch(folder, 9)
+        os.utime(folder, (1000000000, 1000000000))
+        self.assertEqual(robot.get_max_id(folder), 9)
+        self.assertEqual(robot.get_max_id(folder), 9)
+
+
+class BatchTest(RobotTestCase):
+
+    def test_read_batch(self):
+        filename = os.path.join(self.folder, 'queries.txt')
+        with open(filename, 'w') as output:
+            output.write('# comment\n\ncats: cat_ears rating:s\nnegima\n')
+        robot = self.robot()
+        self.assertEqual(robot.read_batch(filename),
+            [('cats', ['cat_ears', 'rating:s']), (None, ['negima'])])
+
+    def test_missing_batch(self):
+        robot = self.robot()
+        stderr, danbooru.stderr = danbooru.stderr, StringIO()
+        try:
+            robot.run_batch(os.path.join(self.folder, 'missing.txt'))
+            self.assertTrue('Can\'t read the batch file' in
+                danbooru.stderr.getvalue())
+        finally:
+            danbooru.stderr = stderr
+
+
+class StoreTest(RobotTestCase):
+
+    def setUp(self):
+        RobotTestCase.setUp(self)
+        self.rename = os.rename
+
+    def tearDown(self):
+        os.rename = self.rename
+        RobotTestCase.tearDown(self)
+
+    def test_other_filesystem(self):
+        def rename(source, destination):
+            if os.path.basename(destination) != hash + '.jpg':
+                return self.rename(source, destination)
+            raise OSError(errno.EXDEV, 'Invalid cross-device link')
+        store = os.path.join(self.folder, 'store')
+        robot = self.robot('--store', store)
+        filename = os.path.join(self.folder, '0000001_x.jpg')
+        with open(filename, 'w') as output:
+            output.write('content')
+        filename, hash = danbooru.hash_file(filename)
+        os.rename = rename
+        quietly(robot.store_files, {filename: hash})
+        blob = robot.blob_path(hash, '.jpg')
+        self.assertEqual(open(blob).read(), 'content')
+        self.assertTrue(os.path.samefile(blob, filename))
+        # A copy elsewhere is replaced with a link to the blob
+        duplicate = os.path.join(self.folder, '0000002_x.jpg')
+        shutil.copy(blob, duplicate)
+        quietly(robot.store_files, {duplicate: hash})
+        self.assertTrue(os.path.samefile(blob, duplicate))
+        self.assertFalse(os.path.exists(duplicate + '.link'))
+
+
+class WorkerPoolTest(unittest.TestCase):
+
+    def test_errors(self):
+        pool = danbooru.WorkerPool(lambda item: 10 // item, 2)
+        for item in (1, 0, 5):
+            pool.put(item)
+        results = sorted(pool.get() for i in xrange(3))
+        pool.close()
+        self.assertEqual(pool.pending, 0)
+        self.assertEqual([item for item, result, error in results], [0, 1, 5])
+        self.assertTrue(isinstance(results[0][2], ZeroDivisionError))
+        self.assertEqual([result for item, result, error in results[1:]],
+            [10, 2])
+
+
+class ProfilerTest(RobotTestCase):
+
+    def test_threads(self):
+        def on_main(): pass
+        def on_worker(): pass
+        profiler = danbooru.Profiler()
+        profiler.runcall(on_main)
+        worker = threading.Thread(target=profiler.runcall, args=(on_worker,))
+        worker.start()
+        worker.join()
+        filename = os.path.join(self.folder, 'profile')
+        profiler.dump_stats(filename)
+        names = [name for path, line, name in pstats.Stats(filename).stats]
+        self.assertTrue('on_main' in names and 'on_worker' in names)
+
+
+class AllocateTest(RobotTestCase):
+
+    def test_reserved(self):
+        if not danbooru.platform.startswith('linux'):
+            # There may be no posix_fallocate to reserve the space elsewhere
+            return
+        part = os.path.join(self.folder, 'post.jpg.part')
+        danbooru.HTTPPool().allocate(part, 2 ** 20)
+        stat = os.stat(part)
+        self.assertEqual(stat.st_size, 2 ** 20)
+        # Not just a sparse file of that size
+        self.assertTrue(stat.st_blocks * 512 >= 2 ** 20)
+        try:
+            danbooru.posix_fallocate(-1, 0, 1)
+        except OSError, e:
+            self.assertEqual(e.errno, errno.EBADF)
+        else:
+            self.fail('bad descriptor not reported')
+
+
+class RetryTest(RobotTestCase):
+    '''Throttling and retries against a MockServer that answers 503 (with
+    Retry-After: 0) to every request while its errors is 1'''
+
+    def setUp(self):
+        RobotTestCase.setUp(self)
+        self.mock = MockServer(count=3, size=2 ** 12, errors=1).start()
+        self.http = danbooru.HTTPPool(timeout=5, per_host=4)
+        self.http.proxies = {}
+        self.pauses = []
+
+    def tearDown(self):
+        hang_up(self.http)
+        self.mock.shutdown()
+        self.mock.server_close()
+        RobotTestCase.tearDown(self)
+
+    def file_url(self, id):
+        return '%sdata/%s.jpg' % (self.mock.url, self.mock.hashes[id])
+
+    def test_window(self):
+        throttle = self.http.throttle(urlsplit(self.mock.url)[1])
+        self.assertEqual(throttle.limit, 4)
+        for limit in (2, 1, 1):
+            self.assertRaises(danbooru.HTTPError, self.http.open,
+                self.file_url(1))
+            self.assertEqual(throttle.limit, limit)
+        # One more after as many successes as the window is wide
+        self.mock.errors = 0
+        for limit in (2, 2, 3, 3, 3, 4, 4):
+            self.http.open(self.file_url(1)).read()
+            self.assertEqual(throttle.limit, limit)
+        throttle.feedback(429)
+        self.assertEqual(throttle.limit, 2)
+
+    def test_rest(self):
+        throttle = danbooru.Throttle(ceiling=1)
+        with throttle:
+            self.assertEqual(throttle.active, 1)
+            resting = threading.Thread(target=throttle.rest, args=(.2,))
+            resting.start()
+            sleep(.1)
+            self.assertEqual(throttle.active, 0)
+            resting.join()
+            self.assertEqual(throttle.active, 1)
+        self.assertEqual(throttle.active, 0)
+
+    def test_backoff(self):
+        for attempt in xrange(10):
+            self.assertTrue(0 <= danbooru.backoff(attempt) <= min(60,
+                2 ** attempt))
+        error = danbooru.HTTPError(429, 'slow down', 'url', '30')
+        self.assertEqual(danbooru.backoff(0, error), 30)
+        error = danbooru.HTTPError(503, 'try again', 'url', '1e9')
+        self.assertEqual(error.retry_after, 300)
+
+    def test_retrieve(self):
+        destination = os.path.join(self.folder, 'post.jpg')
+        body = self.mock.body(1)
+        retrieve = lambda: self.http.retrieve(self.file_url(1), destination,
+            size=len(body), hash=self.mock.hashes[1],
+            pause=self.pauses.append)
+        self.assertRaises(danbooru.HTTPError, retrieve)
+        self.assertEqual(len(self.pauses), self.http.retries)
+        self.assertTrue(os.path.exists(destination + '.part'))
+        self.mock.errors = 0
+        self.assertEqual(retrieve(), len(body))
+        self.assertEqual(open(destination, 'rb').read(), body)
+        self.assertFalse(os.path.exists(destination + '.part'))
+
+    def test_md5_mismatch(self):
+        self.mock.errors = 0
+        destination = os.path.join(self.folder, 'post.jpg')
+        try:
+            self.http.retrieve(self.file_url(1), destination, hash='0' * 32,
+                pause=self.pauses.append)
+        except danbooru.IntegrityError, e:
+            self.assertFalse(danbooru.retryable(e))
+        else:
+            self.fail('md5 mismatch not raised')
+        self.assertEqual(self.pauses, [])
+        self.assertTrue(os.path.exists(destination + '.bad'))
+        self.assertFalse(os.path.exists(destination))
+
+    def test_stale_journal(self):
+        self.mock.errors = 0
+        destination = os.path.join(self.folder, 'post.jpg')
+        body, url = self.mock.body(1), self.file_url(1)
+        expected = '%s\n%d\n%s\n' % (url, len(body), self.mock.hashes[1])
+        # A journal without an offset, next to a .part that isn't the start
+        # of the file
+        with open(destination + '.part', 'wb') as output:
+            output.write('x' * 100)
+        with open(destination + '.journal', 'w') as output:
+            output.write(expected)
+        starts = []
+        report = lambda blocks, blocksize, size: starts.append(blocks)
+        self.http.retrieve(url, destination, report, 1, size=len(body),
+            hash=self.mock.hashes[1], pause=self.pauses.append)
+        # Started from the first byte rather than resumed
+        self.assertEqual(starts[0], 0)
+        self.assertEqual(open(destination, 'rb').read(), body)
+        self.assertFalse(os.path.exists(destination + '.journal'))
+
+    def test_retry_queue(self):
+        queue = danbooru.RetryQueue(attempts=2)
+        busy = danbooru.HTTPError(503, 'try again', 'url', '0')
+        self.assertTrue(queue.put(1, 'a', busy))
+        self.assertTrue(queue.put(2, 'b', busy, 2))
+        self.assertFalse(queue.put(3, 'c', busy, 3))
+        self.assertFalse(queue.put(4, 'd',
+            danbooru.HTTPError(404, 'not found', 'url')))
+        self.assertFalse(queue.put(5, 'e', danbooru.IntegrityError('md5')))
+        self.assertEqual(sorted(queue.keys()), [1, 2])
+        # Skip the backoff
+        queue.heap = [(0,) + item[1:] for item in queue.heap]
+        self.assertEqual(queue.due(), {1: ('a', 1), 2: ('b', 2)})
+        self.assertEqual(len(queue), 0)
+
+    def test_requeue(self):
+        robot = quietly(mock_robot, self.folder, self.mock, '-t', '2',
+            'posts')
+        self.robots.append(robot)
+        robot.http.retries = 0
+        os.mkdir(robot.folder)
+        data = dict(danbooru.parse_data(StringIO(self.mock.posts([1, 2, 3])),
+            'post', 'id'))
+        self.assertEqual(quietly(robot.download, data), {})
+        self.assertEqual(sorted(robot.retry_queue.keys()), [1, 2, 3])
+        self.mock.errors = 0
+        self.assertEqual(sorted(quietly(robot.retry, True)), [1, 2, 3])
+        self.assertEqual(len(robot.retry_queue), 0)
+        self.assertEqual(len(robot.get_filenames(robot.folder)), 3)
+
+    def test_unfinished(self):
+        self.mock.errors = 0
+        robot = quietly(mock_robot, self.folder, self.mock, '--sync', 'posts')
+        self.robots.append(robot)
+        # Given up on in an earlier query of the same batch
+        robot.unfinished.add(1)
+        quietly(robot.retrieve_content)
+        self.assertEqual(robot.get_cursor(), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()